@@ -0,0 +1,220 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Beam search that drops finished sentences from the decoding batch."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import tensorflow as tf
+
+from tensorflow.python.util import nest
+
+__all__ = ["compact_beam_search"]
+
+
+def _length_penalty(length, penalty_factor):
+  """Length penalty of Wu et al. (2016), the one of BeamSearchDecoder."""
+  return tf.pow((5.0 + tf.to_float(length)) / 6.0, penalty_factor)
+
+
+def _gather_beams(tensor, indices):
+  """tensor[i, indices[i, j]] for tensor [n, m, ...] and indices [n, j]."""
+  rows = tf.tile(tf.expand_dims(tf.range(tf.shape(indices)[0]), 1),
+                 [1, tf.shape(indices)[1]])
+  return tf.gather_nd(tensor, tf.stack([rows, indices], 2))
+
+
+def _merge_finished(finished_scores, finished_ids, sentences, scores, ids):
+  """Keep the best of the finished and the new hypotheses of sentences.
+
+  Args:
+    finished_scores: [batch_size, beam_width] scores of the finished
+      hypotheses of every sentence, best first.
+    finished_ids: [batch_size, beam_width, time] their ids.
+    sentences: [n] batch indices of the sentences of scores and ids.
+    scores: [n, m] scores of new finished hypotheses.
+    ids: [n, m, time] their ids.
+
+  Returns:
+    The updated finished_scores and finished_ids.
+  """
+  beam_width = finished_scores.shape[1].value
+  candidate_scores = tf.concat(
+      [tf.gather(finished_scores, sentences), scores], 1)
+  candidate_ids = tf.concat([tf.gather(finished_ids, sentences), ids], 1)
+  best_scores, best = tf.nn.top_k(candidate_scores, beam_width)
+  best_ids = _gather_beams(candidate_ids, best)
+
+  indices = tf.expand_dims(sentences, 1)
+  updated = tf.scatter_nd(indices, tf.ones_like(sentences),
+                          tf.shape(finished_scores)[:1]) > 0
+  finished_scores = tf.where(
+      updated,
+      tf.scatter_nd(indices, best_scores, tf.shape(finished_scores)),
+      finished_scores)
+  finished_ids = tf.where(
+      updated,
+      tf.scatter_nd(indices, best_ids, tf.shape(finished_ids)),
+      finished_ids)
+  return finished_scores, finished_ids
+
+
+def compact_beam_search(cell,
+                        embedding_fn,
+                        output_fn,
+                        initial_state,
+                        start_tokens,
+                        end_token,
+                        beam_width,
+                        length_penalty_weight,
+                        maximum_iterations,
+                        num_kept=1,
+                        output_time_major=False,
+                        swap_memory=False):
+  """Beam search decoding a shrinking batch of unfinished sentences.
+
+  Hypotheses ending with end_token leave the beam for a per-sentence store
+  of the beam_width best finished ones.  A sentence leaves the decoding
+  batch once its num_kept best finished hypotheses score higher than any
+  of its live hypotheses can: with length_penalty_weight >= 0, a live
+  hypothesis scores at most its log-probability over the length penalty of
+  maximum_iterations.  The cell state and beams of the remaining sentences
+  are compacted at every step, and results are stored by batch index, so
+  they come out in the original order.
+
+  Args:
+    cell: the decoder RNNCell, called on [n * beam_width, depth] inputs.
+    embedding_fn: called with ids [n, beam_width] and the batch indices [n]
+      of their sentences, returns their inputs [n, beam_width, depth].
+    output_fn: called with cell outputs [n, beam_width, units] and the batch
+      indices [n], returns log-probabilities [n, beam_width, num_ids].
+    initial_state: the cell state of the whole batch, tiled beam_width times
+      with tf.contrib.seq2seq.tile_batch.
+    start_tokens: int32 vector [batch_size].
+    end_token: int32 scalar.
+    beam_width: Python int.
+    length_penalty_weight: float >= 0.
+    maximum_iterations: int32 scalar, the maximum number of steps.
+    num_kept: number of best hypotheses that must be final for a sentence to
+      stop, i.e. the number of translations that are used.
+    output_time_major: whether predicted_ids is time-major.
+    swap_memory: passed to the while loop.
+
+  Returns:
+    predicted_ids: int32 [batch_size, time, beam_width], or [time,
+      batch_size, beam_width] if output_time_major, best hypothesis first
+      and padded with end_token.
+    final_state: the cell state of the sentences still decoded at the end.
+  """
+  batch_size = tf.shape(start_tokens)[0]
+  neg_inf = float("-inf")
+  max_penalty = _length_penalty(maximum_iterations, length_penalty_weight)
+  num_kept = max(min(num_kept, beam_width), 1)
+
+  def cond(time, sentences, *unused_args):
+    return tf.logical_and(time < maximum_iterations, tf.size(sentences) > 0)
+
+  def body(time, sentences, ids, log_probs, hypotheses, state,
+           finished_scores, finished_ids):
+    n = tf.size(sentences)
+    inputs = embedding_fn(ids, sentences)
+    inputs = tf.reshape(inputs, [n * beam_width, inputs.shape[-1].value])
+    cell_outputs, state = cell(inputs, state)
+    cell_outputs = tf.reshape(
+        cell_outputs, [n, beam_width, cell_outputs.shape[-1].value])
+    step_log_probs = output_fn(cell_outputs, sentences)
+    num_ids = tf.shape(step_log_probs)[-1]
+
+    # 2 * beam_width candidates leave beam_width live ones after ended ones
+    total_log_probs = tf.expand_dims(log_probs, 2) + step_log_probs
+    scores, indices = tf.nn.top_k(
+        tf.reshape(total_log_probs, [n, -1]), 2 * beam_width)
+    candidate_ids = indices % num_ids
+    parents = indices // num_ids
+    candidate_hypotheses = tf.concat(
+        [_gather_beams(hypotheses, parents),
+         tf.expand_dims(candidate_ids, 2)], 2)
+    ended = tf.equal(candidate_ids, end_token)
+    neg_infs = tf.fill(tf.shape(scores), neg_inf)
+
+    finished_ids = tf.pad(finished_ids, [[0, 0], [0, 0], [0, 1]],
+                          constant_values=end_token)
+    finished_scores, finished_ids = _merge_finished(
+        finished_scores, finished_ids, sentences,
+        tf.where(ended,
+                 scores / _length_penalty(time + 1, length_penalty_weight),
+                 neg_infs),
+        candidate_hypotheses)
+
+    log_probs, live = tf.nn.top_k(tf.where(ended, neg_infs, scores),
+                                  beam_width)
+    ids = _gather_beams(candidate_ids, live)
+    hypotheses = _gather_beams(candidate_hypotheses, live)
+    rows = tf.expand_dims(tf.range(n) * beam_width, 1)
+    rows = tf.reshape(rows + _gather_beams(parents, live), [-1])
+    state = nest.map_structure(lambda s: tf.gather(s, rows), state)
+
+    # drop the sentences whose num_kept best hypotheses can't change
+    best_live = tf.reduce_max(log_probs, 1) / max_penalty
+    kept = tf.gather(finished_scores, sentences)[:, num_kept - 1]
+    live_sentences = kept < best_live
+    live_rows = tf.reshape(
+        tf.tile(tf.expand_dims(live_sentences, 1), [1, beam_width]), [-1])
+    state = nest.map_structure(
+        lambda s: tf.boolean_mask(s, live_rows), state)
+    return (time + 1,
+            tf.boolean_mask(sentences, live_sentences),
+            tf.boolean_mask(ids, live_sentences),
+            tf.boolean_mask(log_probs, live_sentences),
+            tf.boolean_mask(hypotheses, live_sentences),
+            state,
+            finished_scores,
+            finished_ids)
+
+  loop_vars = (
+      tf.constant(0),
+      tf.range(batch_size),
+      tf.tile(tf.expand_dims(start_tokens, 1), [1, beam_width]),
+      tf.tile([[0.0] + [neg_inf] * (beam_width - 1)], [batch_size, 1]),
+      tf.zeros([batch_size, beam_width, 0], tf.int32),
+      initial_state,
+      tf.fill([batch_size, beam_width], neg_inf),
+      tf.zeros([batch_size, beam_width, 0], tf.int32))
+  shape_invariants = (
+      tf.TensorShape([]),
+      tf.TensorShape([None]),
+      tf.TensorShape([None, beam_width]),
+      tf.TensorShape([None, beam_width]),
+      tf.TensorShape([None, beam_width, None]),
+      nest.map_structure(
+          lambda s: tf.TensorShape([None]).concatenate(s.shape[1:]),
+          initial_state),
+      tf.TensorShape([None, beam_width]),
+      tf.TensorShape([None, beam_width, None]))
+  (time, sentences, _, log_probs, hypotheses, final_state, finished_scores,
+   finished_ids) = tf.while_loop(
+       cond, body, loop_vars,
+       shape_invariants=shape_invariants,
+       swap_memory=swap_memory)
+
+  # sentences cut by maximum_iterations keep their live hypotheses too
+  _, predicted_ids = _merge_finished(
+      finished_scores, finished_ids, sentences,
+      log_probs / _length_penalty(time, length_penalty_weight),
+      hypotheses)
+  if output_time_major:
+    return tf.transpose(predicted_ids, [2, 0, 1]), final_state
+  return tf.transpose(predicted_ids, [0, 2, 1]), final_state
@@ -0,0 +1,340 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Compare quality, speed and size of inference models on a dev set.
+
+  python -m nmt.benchmark --model_dirs=out_dir,export_dir \\
+      --inference_input_file=dev.src --inference_ref_file=dev.tgt
+
+The first model dir is the baseline the others are compared to.  With
+--output_layer_shape, the fused copy+vocab log-softmax of the output layer is
+also compared to the former softmax path.  Throughput and latencies are
+reported as measured, with their change from the baseline.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from . import inference
+from . import model as nmt_model
+from . import model_helper
+from . import nmt
+from .utils import misc_utils as utils
+from .utils import nmt_utils
+
+FLAGS = None
+
+
+def add_arguments(parser):
+  """Build ArgumentParser."""
+  nmt.add_arguments(parser)
+  parser.add_argument("--model_dirs", type=str, default=None,
+                      help=("Comma-separated model or export dirs, the first"
+                            " one is the baseline."))
+  parser.add_argument("--output_ranks", type=str, default=None,
+                      help=("""\
+      Comma-separated output_rank values to also benchmark the first model
+      at, its vocab_W factorized by truncated SVD when loaded.\
+      """))
+  parser.add_argument("--num_latency_sentences", type=int, default=100,
+                      help=("Sentences decoded one at a time to measure"
+                            " latency."))
+  parser.add_argument("--output_layer_shape", type=str, default=None,
+                      help=("""\
+      time,batch,source_len: compare the outputs, gradients, step time and
+      peak memory of the fused copy+vocab log-softmax and of the former
+      softmax path on random scores of that shape, over the first model's
+      target vocab.\
+      """))
+
+
+def _model_bytes(graph, session, scope=""):
+  """Bytes of the model variables, i.e. of the exported weights."""
+  variables = [
+      v for v in graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
+      if scope in v.op.name]
+  return sum(value.nbytes for value in session.run(variables))
+
+
+def _former_log_probs(vocab_logits, copy_logits, source_mask):
+  """The output before the fused log-softmax.
+
+  Softmax over vocab and copy scores, masked to the valid source positions,
+  renormalised, smoothed by 1e-8 and logged.
+  """
+  num_steps = tf.shape(vocab_logits)[0]
+  source_weights = tf.concat(
+      [tf.ones_like(vocab_logits),
+       tf.tile(source_mask[None, :, :], [num_steps, 1, 1])], -1)
+  probs = tf.nn.softmax(
+      tf.concat([vocab_logits, copy_logits], -1)) * source_weights
+  probs /= tf.reduce_sum(probs, -1, keep_dims=True)
+  return tf.log(probs + 1e-8)
+
+
+def _fused_log_probs(vocab_logits, copy_logits, source_mask):
+  """The output of model.Output: one masked log-softmax, smoothed."""
+  copy_logits += (source_mask[None, :, :] - 1) * 1e9
+  return nmt_model.log_add_epsilon(
+      tf.nn.log_softmax(tf.concat([vocab_logits, copy_logits], -1)))
+
+
+def _peak_bytes(run_metadata):
+  """Most bytes in use by an allocator during a traced run."""
+  peak = 0
+  for dev_stats in run_metadata.step_stats.dev_stats:
+    for node_stats in dev_stats.node_stats:
+      for memory in node_stats.memory:
+        peak = max(peak, memory.allocator_bytes_in_use, memory.peak_bytes)
+  return peak
+
+
+def benchmark_output_layer(vocab_size, num_steps, batch_size, source_len,
+                           num_runs=10):
+  """Compare the fused output log-softmax to the former path.
+
+  Both paths get the same random time-major scores, with random source
+  lengths, and are differentiated through a cross entropy loss like in
+  training.
+
+  Returns:
+    The largest absolute differences of their log-probabilities
+    (max_output_diff) and gradients (max_gradient_diff), and for each of
+    "former" and "fused" the mean step_time, in seconds, and the peak_bytes
+    of a forward and backward run.
+  """
+  graph = tf.Graph()
+  with graph.as_default():
+    vocab_logits = tf.Variable(
+        tf.random_normal([num_steps, batch_size, vocab_size], seed=1))
+    copy_logits = tf.Variable(
+        tf.random_normal([num_steps, batch_size, source_len], seed=2))
+    source_mask = tf.Variable(tf.sequence_mask(
+        tf.random_uniform([batch_size], 1, source_len + 1, dtype=tf.int32,
+                          seed=3),
+        source_len, dtype=tf.float32))
+    labels = tf.Variable(tf.random_uniform(
+        [num_steps, batch_size], 0, vocab_size, dtype=tf.int32, seed=4))
+    paths = {}
+    for name, log_probs_fn in [("former", _former_log_probs),
+                               ("fused", _fused_log_probs)]:
+      log_probs = log_probs_fn(vocab_logits, copy_logits, source_mask)
+      loss = tf.reduce_sum(tf.nn.sparse_softmax_cross_entropy_with_logits(
+          labels=labels, logits=log_probs))
+      paths[name] = [log_probs] + tf.gradients(
+          loss, [vocab_logits, copy_logits])
+    initializer = tf.global_variables_initializer()
+
+  results = {}
+  values = {}
+  with tf.Session(graph=graph, config=utils.get_config_proto()) as sess:
+    sess.run(initializer)
+    for name, fetches in paths.items():
+      sess.run(fetches)  # warm up
+      start_time = time.time()
+      for _ in range(num_runs):
+        sess.run(fetches)
+      step_time = (time.time() - start_time) / num_runs
+      run_metadata = tf.RunMetadata()
+      values[name] = sess.run(
+          fetches,
+          options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+          run_metadata=run_metadata)
+      results[name] = {"step_time": step_time,
+                       "peak_bytes": _peak_bytes(run_metadata)}
+  results["max_output_diff"] = np.max(
+      np.abs(values["former"][0] - values["fused"][0]))
+  results["max_gradient_diff"] = max(
+      np.max(np.abs(former - fused))
+      for former, fused in zip(values["former"][1:], values["fused"][1:]))
+  return results
+
+
+def benchmark_model(name, ckpt, hparams, src_file, ref_file, trans_file,
+                    num_latency_sentences):
+  """Decode src_file with a model and measure its speed and scores.
+
+  Returns:
+    A dict with the evaluation scores of hparams.metrics, the batched
+    decoding throughput (sentences_per_sec), the p50 and p90 latency of
+    decoding a single sentence (latency_p50, latency_p90, in seconds) and
+    the size of the model and output layer weights (model_bytes,
+    output_bytes).
+  """
+  infer_model = model_helper.create_infer_model(
+      inference.get_model_creator(hparams), hparams)
+  infer_data = inference.load_data(src_file)
+
+  with tf.Session(
+      graph=infer_model.graph,
+      config=utils.get_config_proto(
+          num_intra_threads=hparams.num_intra_threads,
+          num_inter_threads=hparams.num_inter_threads)) as sess:
+    loaded_infer_model = model_helper.load_model(
+        infer_model.model, ckpt, sess, name)
+    infer_model.graph.finalize()  # decoding must not add ops
+    results = {
+        "model_bytes": _model_bytes(infer_model.graph, sess),
+        "output_bytes": _model_bytes(infer_model.graph, sess,
+                                     scope="output_projection/")}
+
+    # Batched decoding
+    sess.run(
+        infer_model.iterator.initializer,
+        feed_dict={
+            infer_model.src_placeholder: infer_data,
+            infer_model.batch_size_placeholder: hparams.infer_batch_size
+        })
+    start_time = time.time()
+    nmt_utils.decode_and_evaluate(
+        name,
+        loaded_infer_model,
+        sess,
+        trans_file,
+        ref_file=None,
+        src_file=src_file,
+        metrics=hparams.metrics,
+        subword_option=hparams.subword_option,
+        beam_width=hparams.beam_width,
+        tgt_eos=hparams.eos)
+    results["sentences_per_sec"] = (
+        len(infer_data) / max(time.time() - start_time, 1e-6))
+    results.update(nmt_utils.decode_and_evaluate(
+        name,
+        loaded_infer_model,
+        sess,
+        trans_file,
+        ref_file=ref_file,
+        src_file=src_file,
+        metrics=hparams.metrics,
+        subword_option=hparams.subword_option,
+        beam_width=hparams.beam_width,
+        tgt_eos=hparams.eos,
+        decode=False))
+
+    # Single sentence latency
+    latencies = []
+    for sentence in infer_data[:num_latency_sentences]:
+      sess.run(
+          infer_model.iterator.initializer,
+          feed_dict={
+              infer_model.src_placeholder: [sentence],
+              infer_model.batch_size_placeholder: 1
+          })
+      start_time = time.time()
+      loaded_infer_model.decode(sess)
+      latencies.append(time.time() - start_time)
+    if latencies:
+      results["latency_p50"] = np.percentile(latencies, 50)
+      results["latency_p90"] = np.percentile(latencies, 90)
+  return results
+
+
+def _change(value, baseline):
+  """Percent change of value from baseline."""
+  return 100.0 * (value - baseline) / max(baseline, 1e-12)
+
+
+def print_comparison(names, results, metrics):
+  """Print every model's results and their change from the first model."""
+  baseline = results[0]
+  for name, result in zip(names, results):
+    line = ("  %s: %.1fMB (x%.2f), output layer %.1fMB, %.1f sents/s"
+            " (%+.1f%%)" % (
+                name, result["model_bytes"] / 2.0**20,
+                result["model_bytes"] / float(baseline["model_bytes"]),
+                result["output_bytes"] / 2.0**20,
+                result["sentences_per_sec"],
+                _change(result["sentences_per_sec"],
+                        baseline["sentences_per_sec"])))
+    if "latency_p50" in result:
+      line += ", latency p50 %.1fms (%+.1f%%) p90 %.1fms (%+.1f%%)" % (
+          result["latency_p50"] * 1000,
+          _change(result["latency_p50"], baseline["latency_p50"]),
+          result["latency_p90"] * 1000,
+          _change(result["latency_p90"], baseline["latency_p90"]))
+    for metric in metrics:
+      if metric in result and metric in baseline:
+        line += ", %s %.2f (%+.2f)" % (metric, result[metric],
+                                       result[metric] - baseline[metric])
+    utils.print_out(line)
+
+
+def main(unused_argv):
+  default_hparams = nmt.create_hparams(FLAGS)
+  model_dirs = FLAGS.model_dirs.split(",")
+  runs = [(model_dir, None) for model_dir in model_dirs]
+  if FLAGS.output_ranks:
+    runs += [(model_dirs[0], int(rank))
+             for rank in FLAGS.output_ranks.split(",")]
+
+  names, results = [], []
+  for model_dir, output_rank in runs:
+    hparams = utils.load_hparams(model_dir)
+    if not hparams:
+      raise ValueError("No hparams in %s" % model_dir)
+    hparams = nmt.ensure_compatible_hparams(
+        hparams, default_hparams, FLAGS.hparams_path)
+    ckpt = tf.train.latest_checkpoint(model_dir)
+    name = os.path.basename(os.path.normpath(model_dir))
+    if output_rank is not None:
+      hparams.output_rank = output_rank
+      hparams.tie_output_embedding = False
+      name += "_rank%d" % output_rank
+    utils.print_out("# Benchmarking %s as %s" % (ckpt, name))
+    names.append(name)
+    results.append(benchmark_model(
+        name, ckpt, hparams,
+        FLAGS.inference_input_file,
+        FLAGS.inference_ref_file,
+        os.path.join(model_dir, "benchmark_output_%s" % name),
+        FLAGS.num_latency_sentences))
+  utils.print_out("# Benchmark of %s" % FLAGS.inference_input_file)
+  print_comparison(names, results, default_hparams.metrics)
+
+  if FLAGS.output_layer_shape:
+    num_steps, batch_size, source_len = [
+        int(size) for size in FLAGS.output_layer_shape.split(",")]
+    vocab_size = utils.load_hparams(model_dirs[0]).tgt_vocab_size
+    output = benchmark_output_layer(
+        vocab_size, num_steps, batch_size, source_len)
+    utils.print_out(
+        "# Output layer, %d steps x %d batch x (%d vocab + %d source)" %
+        (num_steps, batch_size, vocab_size, source_len))
+    for name in ["former", "fused"]:
+      utils.print_out(
+          "  %s: %.1fms/step (%+.1f%%), peak %.1fMB (%+.1f%%)" % (
+              name, output[name]["step_time"] * 1000,
+              _change(output[name]["step_time"],
+                      output["former"]["step_time"]),
+              output[name]["peak_bytes"] / 2.0**20,
+              _change(output[name]["peak_bytes"],
+                      output["former"]["peak_bytes"])))
+    utils.print_out("  max difference: outputs %.3g, gradients %.3g" %
+                    (output["max_output_diff"], output["max_gradient_diff"]))
+
+
+if __name__ == "__main__":
+  benchmark_parser = argparse.ArgumentParser()
+  add_arguments(benchmark_parser)
+  FLAGS, unparsed = benchmark_parser.parse_known_args()
+  nmt.FLAGS = FLAGS
+  tf.app.run(main=main, argv=[sys.argv[0]] + unparsed)
@@ -0,0 +1,131 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""On-disk cache of the encoder outputs and final state of sources.
+
+  generator = QuestionGenerator("model_dir", encoder_cache_dir="cache_dir")
+  generator.generate(["select ...", ...])
+  generator.encoder_cache.stats()  # -> hits, misses, evictions, ...
+
+Every source is stored with its unpadded encoder outputs, [length, units],
+and the rows of its final state, keyed by the whitespace-normalized source,
+a fingerprint of the checkpoint and src_max_len_infer.  Batches of cached
+sources are decoded by feeding their states to the encoder's tensors, so
+the encoder doesn't run.  Unlike generation_cache, hits are still decoded,
+with any beam width or sampling settings.
+"""
+from __future__ import print_function
+
+import hashlib
+import io
+import json
+import sqlite3
+
+import numpy as np
+
+from . import generation_cache
+
+__all__ = ["EncoderStateCache", "split_batch", "batch_feed"]
+
+ENCODER_CACHE_FILE = "encoder_cache.sqlite"
+
+
+class EncoderStateCache(generation_cache.DiskCache):
+  """sqlite cache of encoder states of at most about max_bytes.
+
+  Values are (outputs, states) pairs of numpy arrays, least recently used
+  out.  Several processes may share a cache_dir.
+  """
+
+  def __init__(self, cache_dir, max_bytes):
+    super(EncoderStateCache, self).__init__(
+        cache_dir, max_bytes, file_name=ENCODER_CACHE_FILE)
+    self.hits = 0
+    self.misses = 0
+
+  def key(self, source, fingerprint, src_max_len):
+    key = json.dumps([fingerprint, src_max_len,
+                      generation_cache.normalize_source(source)])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+  def lookup(self, keys):
+    """get_many of keys, counting a hit or a miss per key."""
+    keys = list(keys)
+    values = self.get_many(set(keys))
+    hits = sum(1 for key in keys if key in values)
+    self.hits += hits
+    self.misses += len(keys) - hits
+    return values
+
+  def _dumps(self, value):
+    outputs, states = value
+    f = io.BytesIO()
+    np.savez(f, outputs, *states)
+    return sqlite3.Binary(f.getvalue())
+
+  def _loads(self, value):
+    arrays = np.load(io.BytesIO(bytes(value)))
+    arrays = [arrays["arr_%d" % i] for i in range(len(arrays.files))]
+    return arrays[0], arrays[1:]
+
+  def stats(self):
+    """Hit and miss counts, hit rate, bytes stored and evictions."""
+    return {
+        "hits": self.hits,
+        "misses": self.misses,
+        "hit_rate": self.hits / float(max(self.hits + self.misses, 1)),
+        "bytes": self.size(),
+        "evictions": self.evictions,
+    }
+
+
+def split_batch(encoder_outputs, encoder_states, source_lengths, time_major):
+  """The cache values of every source of an encoded batch.
+
+  Args:
+    encoder_outputs: [max_time, batch_size, units] if time_major, else
+      [batch_size, max_time, units].
+    encoder_states: the flattened final state, [batch_size, units] arrays.
+    source_lengths: [batch_size] lengths of the sources.
+    time_major: the layout of encoder_outputs.
+
+  Returns:
+    An (outputs, states) pair per source, without the padding.
+  """
+  if time_major:
+    encoder_outputs = np.transpose(encoder_outputs, [1, 0, 2])
+  return [(encoder_outputs[i, :length],
+           [state[i] for state in encoder_states])
+          for i, length in enumerate(source_lengths)]
+
+
+def batch_feed(outputs_tensor, state_tensors, values, time_major):
+  """feed_dict of the encoder tensors with the cached values of a batch.
+
+  The values are padded with zeros to their longest source, like the
+  iterator pads the batch of those sources.
+  """
+  max_time = max(outputs.shape[0] for outputs, _ in values)
+  units = values[0][0].shape[1]
+  encoder_outputs = np.zeros([len(values), max_time, units],
+                             dtype=values[0][0].dtype)
+  for i, (outputs, _) in enumerate(values):
+    encoder_outputs[i, :outputs.shape[0]] = outputs
+  if time_major:
+    encoder_outputs = np.transpose(encoder_outputs, [1, 0, 2])
+  feed_dict = {outputs_tensor: encoder_outputs}
+  for i, tensor in enumerate(state_tensors):
+    feed_dict[tensor] = np.stack([states[i] for _, states in values])
+  return feed_dict
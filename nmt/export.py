@@ -0,0 +1,193 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Export trained checkpoints as inference models."""
+from __future__ import print_function
+
+import json
+import os
+import time
+
+import tensorflow as tf
+
+from tensorflow.tools.graph_transforms import TransformGraph
+
+from . import inference
+from . import model_helper
+from . import question_generator
+from .utils import misc_utils as utils
+from .utils import quantize_utils
+
+__all__ = ["export", "export_quantized_model", "export_frozen_model"]
+
+
+def _export_hparams(hparams, export_dir, **overrides):
+  """A copy of hparams for a model exported to export_dir."""
+  export_hparams = tf.contrib.training.HParams(**hparams.values())
+  for metric in hparams.metrics:
+    setattr(export_hparams, "best_" + metric + "_dir", export_dir)
+  for key, value in overrides.items():
+    setattr(export_hparams, key, value)
+  return export_hparams
+
+
+def export_quantized_model(ckpt, export_dir, hparams):
+  """Export ckpt as an int8 inference model to export_dir.
+
+  The matrices of quantize_utils.QUANTIZED_VARIABLES are stored as int8 with
+  float scales, other variables are copied.  Decode with
+  --out_dir=export_dir, whose saved hparams set quantize_infer.
+  """
+  start_time = time.time()
+  export_hparams = _export_hparams(hparams, export_dir, quantize_infer=True)
+  infer_model = model_helper.create_infer_model(
+      inference.get_model_creator(export_hparams), export_hparams)
+  reader = tf.train.NewCheckpointReader(ckpt)
+
+  float_bytes, export_bytes = 0, 0
+  with tf.Session(
+      graph=infer_model.graph, config=utils.get_config_proto()) as sess:
+    quantized = {}
+    for variable in infer_model.graph.get_collection(
+        tf.GraphKeys.GLOBAL_VARIABLES):
+      name = variable.op.name
+      if name.endswith(quantize_utils.INT8_SUFFIX):
+        name = name[:-len(quantize_utils.INT8_SUFFIX)]
+        index = 0
+      elif name.endswith(quantize_utils.SCALE_SUFFIX):
+        name = name[:-len(quantize_utils.SCALE_SUFFIX)]
+        index = 1
+      else:
+        index = None
+      if index is None:
+        value = reader.get_tensor(name)
+        float_bytes += value.nbytes
+      else:
+        if name not in quantized:
+          weights = reader.get_tensor(name)
+          float_bytes += weights.nbytes
+          quantized[name] = quantize_utils.quantize(
+              weights, quantize_utils.scale_axis(name))
+        value = quantized[name][index]
+      variable.load(value, sess)
+      export_bytes += value.nbytes
+
+    if not tf.gfile.Exists(export_dir): tf.gfile.MakeDirs(export_dir)
+    infer_model.model.saver.save(
+        sess,
+        os.path.join(export_dir, "translate.ckpt"),
+        global_step=infer_model.model.global_step)
+  utils.save_hparams(export_dir, export_hparams)
+  utils.print_time(
+      "# Exported %d int8 matrices to %s, %.1fMB -> %.1fMB" %
+      (len(quantized), export_dir, float_bytes / 2.0**20,
+       export_bytes / 2.0**20), start_time)
+
+
+def _sample_source(hparams):
+  """A source sentence to time the first decode on."""
+  dev_src_file = "%s.%s" % (hparams.dev_prefix, hparams.src)
+  if hparams.dev_prefix and tf.gfile.Exists(dev_src_file):
+    data = inference.load_data(dev_src_file)
+    if data:
+      return data[0]
+  return "select"
+
+
+def export_frozen_model(ckpt, export_dir, hparams):
+  """Export ckpt as a self-contained frozen inference graph to export_dir.
+
+  The graph holds the INFER-mode ops needed by the decoded words only, with
+  variables and vocab tables turned into constants, then constant-folded.
+  It is written to export_dir/frozen_model.pb, with the names of its inputs
+  and outputs and the decoding settings in export_dir/frozen_model.json;
+  load it with question_generator.FrozenQuestionGenerator.  The time to the
+  first decode of the checkpoint and of the export are printed.
+  """
+  source = _sample_source(hparams)
+  start_time = time.time()
+  infer_model = model_helper.create_infer_model(
+      inference.get_model_creator(hparams), hparams, embed_vocab=True)
+  model = infer_model.model
+  with infer_model.graph.as_default():
+    words = tf.identity(model.decoded_words, name="frozen_words")
+    copy_positions = tf.identity(
+        model.copy_positions, name="frozen_copy_positions")
+  tensors = {
+      "src_placeholder": infer_model.src_placeholder.name,
+      "batch_size_placeholder": infer_model.batch_size_placeholder.name,
+      "iterator_initializer": infer_model.iterator.initializer.name,
+      "words": words.name,
+      "copy_positions": copy_positions.name,
+  }
+  if hasattr(model, "num_latent_samples"):
+    tensors["num_latent_samples"] = model.num_latent_samples.name
+
+  with tf.Session(
+      graph=infer_model.graph, config=utils.get_config_proto()) as sess:
+    model_helper.load_model(model, ckpt, sess, "infer")
+    tensors["tables_initializer"] = tf.tables_initializer().name
+    sess.run(infer_model.iterator.initializer,
+             feed_dict={infer_model.src_placeholder: [source],
+                        infer_model.batch_size_placeholder: 1})
+    sess.run(words)
+    checkpoint_cold_start = time.time() - start_time
+
+    output_nodes = [name.split(":")[0] for name in (
+        tensors["words"], tensors["copy_positions"],
+        tensors["iterator_initializer"], tensors["tables_initializer"])]
+    graph_def = tf.graph_util.convert_variables_to_constants(
+        sess, infer_model.graph.as_graph_def(), output_nodes)
+  input_nodes = [tensors[key].split(":")[0] for key in (
+      "src_placeholder", "batch_size_placeholder", "num_latent_samples")
+                 if key in tensors]
+  graph_def = TransformGraph(graph_def, input_nodes, output_nodes,
+                             ["fold_constants(ignore_errors=true)"])
+
+  if not tf.gfile.Exists(export_dir): tf.gfile.MakeDirs(export_dir)
+  with tf.gfile.GFile(
+      os.path.join(export_dir, question_generator.FROZEN_GRAPH_FILE),
+      mode="wb") as f:
+    f.write(graph_def.SerializeToString())
+  config = {
+      "tensors": tensors,
+      "hparams": {key: getattr(hparams, key) for key in (
+          question_generator.FROZEN_HPARAMS)},
+  }
+  with tf.gfile.GFile(
+      os.path.join(export_dir, question_generator.FROZEN_CONFIG_FILE),
+      mode="w") as f:
+    f.write(json.dumps(config, indent=2))
+  utils.print_out("# Exported a frozen graph of %d nodes to %s, %.1fMB" %
+                  (len(graph_def.node), export_dir,
+                   graph_def.ByteSize() / 2.0**20))
+
+  start_time = time.time()
+  with question_generator.FrozenQuestionGenerator(export_dir) as generator:
+    generator.generate([source])
+    frozen_cold_start = time.time() - start_time
+  utils.print_out(
+      "  time to first decode: checkpoint %.2fs, frozen export %.2fs" %
+      (checkpoint_cold_start, frozen_cold_start))
+
+
+def export(export_type, ckpt, export_dir, hparams):
+  """Export ckpt to export_dir as an inference model of export_type."""
+  if export_type == "int8":
+    export_quantized_model(ckpt, export_dir, hparams)
+  elif export_type == "frozen":
+    export_frozen_model(ckpt, export_dir, hparams)
+  else:
+    raise ValueError("Unknown export_type %s" % export_type)
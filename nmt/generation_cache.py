@@ -0,0 +1,284 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Cache of generated questions in front of a QuestionGenerator.
+
+  generator = CachedQuestionGenerator(QuestionGenerator("model_dir"),
+                                      cache_dir="cache_dir")
+  generator.generate(["select ...", ...], beam_width=5)
+  generator.stats()  # -> hits, misses, evictions, ...
+
+Results are keyed by the whitespace-normalized source, a fingerprint of the
+checkpoint and the decoding settings: the beam width, samples and
+translations per input and the hparams of DECODE_HPARAMS.  Lookups go to an
+in-memory LRU, then to an sqlite store on disk, and only the misses are
+decoded.
+"""
+from __future__ import print_function
+
+import collections
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import tensorflow as tf
+
+__all__ = ["normalize_source", "checkpoint_fingerprint", "LRUCache",
+           "DiskCache", "CachedQuestionGenerator"]
+
+DISK_CACHE_FILE = "generation_cache.sqlite"
+# Inference hparams that change the questions decoded with a checkpoint.
+DECODE_HPARAMS = ("length_penalty_weight", "sampling_temperature",
+                  "sampling_top_k", "sampling_top_p", "random_seed",
+                  "shortlist_size", "shortlist_lexicon_size",
+                  "compact_beam_search", "src_max_len_infer",
+                  "tgt_max_len_infer", "softmax_mode", "output_rank",
+                  "subword_option", "eos")
+
+
+def normalize_source(source):
+  """The source with runs of whitespace collapsed to single spaces."""
+  return " ".join(source.split())
+
+
+def checkpoint_fingerprint(ckpt):
+  """Hash of ckpt's index, which holds the checksums of every tensor."""
+  index_file = ckpt + ".index"
+  if not tf.gfile.Exists(index_file):
+    index_file = ckpt
+  with tf.gfile.GFile(index_file, mode="rb") as f:
+    return hashlib.sha1(f.read()).hexdigest()
+
+
+class LRUCache(object):
+  """In-memory cache of at most max_entries values, least recent out."""
+
+  def __init__(self, max_entries):
+    self.max_entries = max_entries
+    self._entries = collections.OrderedDict()
+    self.evictions = 0
+
+  def get(self, key):
+    value = self._entries.pop(key, None)
+    if value is not None:
+      self._entries[key] = value
+    return value
+
+  def put(self, key, value):
+    self._entries.pop(key, None)
+    self._entries[key] = value
+    while len(self._entries) > self.max_entries:
+      self._entries.popitem(last=False)
+      self.evictions += 1
+
+  def __len__(self):
+    return len(self._entries)
+
+
+class DiskCache(object):
+  """sqlite cache of at most about max_bytes, least recently used out.
+
+  Several processes may share a cache_dir.  Values are stored as json,
+  subclasses storing other values override _dumps and _loads.
+  """
+
+  def __init__(self, cache_dir, max_bytes, file_name=DISK_CACHE_FILE):
+    if not os.path.exists(cache_dir): os.makedirs(cache_dir)
+    self.max_bytes = max_bytes
+    self.evictions = 0
+    self._db = sqlite3.connect(os.path.join(cache_dir, file_name),
+                               timeout=60)
+    self._db.execute(
+        "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY,"
+        " value TEXT, size INTEGER, accessed REAL)")
+    self._db.execute(
+        "CREATE INDEX IF NOT EXISTS accessed ON results (accessed)")
+    self._db.commit()
+
+  def get_many(self, keys):
+    """The values of the keys found, by key."""
+    values = {}
+    for key in keys:
+      row = self._db.execute(
+          "SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+      if row:
+        values[key] = self._loads(row[0])
+    if values:
+      now = time.time()
+      self._db.executemany("UPDATE results SET accessed = ? WHERE key = ?",
+                           [(now, key) for key in values])
+      self._db.commit()
+    return values
+
+  def put_many(self, items):
+    """Store (key, value) items, then evict down to max_bytes."""
+    now = time.time()
+    rows = []
+    for key, value in items:
+      value = self._dumps(value)
+      rows.append((key, value, len(key) + len(value), now))
+    self._db.executemany(
+        "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", rows)
+    self._evict()
+    self._db.commit()
+
+  def _dumps(self, value):
+    return json.dumps(value)
+
+  def _loads(self, value):
+    return json.loads(value)
+
+  def _evict(self):
+    size = self.size()
+    if size <= self.max_bytes:
+      return
+    excess = size - self.max_bytes
+    freed = 0
+    evicted = []
+    for key, row_size in self._db.execute(
+        "SELECT key, size FROM results ORDER BY accessed"):
+      if freed >= excess:
+        break
+      evicted.append((key,))
+      freed += row_size
+    self._db.executemany("DELETE FROM results WHERE key = ?", evicted)
+    self.evictions += len(evicted)
+
+  def size(self):
+    """Bytes of the stored keys and values."""
+    return self._db.execute(
+        "SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+  def close(self):
+    self._db.close()
+
+
+class CachedQuestionGenerator(object):
+  """A QuestionGenerator that only decodes sources it hasn't seen.
+
+  Hits are served without running the session; within a call, duplicate
+  sources are decoded once.
+  """
+
+  def __init__(self, generator, cache_dir=None, max_memory_entries=100000,
+               max_disk_bytes=2**30):
+    self.generator = generator
+    self._fingerprint_ckpt = generator.ckpt
+    self.fingerprint = checkpoint_fingerprint(generator.ckpt)
+    self.memory_cache = LRUCache(max_memory_entries)
+    self.disk_cache = None
+    if cache_dir:
+      self.disk_cache = DiskCache(cache_dir, max_disk_bytes)
+    self.memory_hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+
+  def _key(self, source, settings):
+    key = json.dumps([self.fingerprint, settings, normalize_source(source)])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+  def generate(self, sources, beam_width=None, num_samples=None,
+               num_translations_per_input=None):
+    """QuestionGenerator.generate, with cached results where available."""
+    hparams = self.generator.hparams
+    if beam_width is None:
+      beam_width = hparams.beam_width
+    if num_samples is None:
+      num_samples = hparams.num_latent_samples
+    if num_translations_per_input is None:
+      num_translations_per_input = hparams.num_translations_per_input
+    if hasattr(self.generator, "reload"):
+      # Key by the checkpoint that will decode the misses.
+      self.generator.reload(beam_width)
+      if self.generator.ckpt != self._fingerprint_ckpt:
+        self._fingerprint_ckpt = self.generator.ckpt
+        self.fingerprint = checkpoint_fingerprint(self.generator.ckpt)
+    settings = [beam_width, num_samples, num_translations_per_input] + [
+        getattr(hparams, name, None) for name in DECODE_HPARAMS]
+    keys = [self._key(source, settings) for source in sources]
+
+    results = {}
+    for key in keys:
+      value = self.memory_cache.get(key)
+      if value is not None:
+        results[key] = value
+    self.memory_hits += len(results)
+    if self.disk_cache:
+      found = self.disk_cache.get_many(
+          set(key for key in keys if key not in results))
+      self.disk_hits += len(found)
+      for key, value in found.items():
+        self.memory_cache.put(key, value)
+      results.update(found)
+
+    missing = collections.OrderedDict()
+    for key, source in zip(keys, sources):
+      if key not in results:
+        missing.setdefault(key, source)
+    self.misses += len(missing)
+    if missing:
+      decoded = self.generator.generate(
+          list(missing.values()),
+          beam_width=beam_width,
+          num_samples=num_samples,
+          num_translations_per_input=num_translations_per_input)
+      items = list(zip(missing.keys(), decoded))
+      for key, value in items:
+        self.memory_cache.put(key, value)
+      if self.disk_cache:
+        self.disk_cache.put_many(items)
+      results.update(items)
+    return [results[key] for key in keys]
+
+  def stats(self):
+    """Hit and miss counts, hit rate and cache sizes."""
+    lookups = self.memory_hits + self.disk_hits + self.misses
+    stats = {
+        "memory_hits": self.memory_hits,
+        "disk_hits": self.disk_hits,
+        "misses": self.misses,
+        "hit_rate": (self.memory_hits + self.disk_hits) / float(
+            max(lookups, 1)),
+        "memory_entries": len(self.memory_cache),
+        "memory_evictions": self.memory_cache.evictions,
+    }
+    if self.disk_cache:
+      stats["disk_bytes"] = self.disk_cache.size()
+      stats["disk_evictions"] = self.disk_cache.evictions
+    encoder_cache = getattr(self.generator, "encoder_cache", None)
+    if encoder_cache:
+      stats["encoder_cache"] = encoder_cache.stats()
+    return stats
+
+  @property
+  def ckpt(self):
+    return self.generator.ckpt
+
+  @property
+  def hparams(self):
+    return self.generator.hparams
+
+  def close(self):
+    if self.disk_cache:
+      self.disk_cache.close()
+    self.generator.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *unused_args):
+    self.close()
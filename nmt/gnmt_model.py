@@ -26,6 +26,7 @@ from tensorflow.python.util import nest
 from . import attention_model
 from . import model_helper
 from .utils import misc_utils as utils
+from .utils import quantize_utils
 
 __all__ = ["GNMTModel"]
 
@@ -79,8 +80,8 @@ class GNMTModel(attention_model.AttentionModel):
 
       # Look up embedding, emp_inp: [max_time, batch_size, num_units]
       #   when time_major = True
-      encoder_emb_inp = tf.nn.embedding_lookup(self.embedding_encoder,
-                                               source)
+      encoder_emb_inp = quantize_utils.embedding_lookup(
+          self.embedding_encoder, source)
 
       # Execute _build_bidirectional_rnn from Model class
       bi_encoder_outputs, bi_encoder_state = self._build_bidirectional_rnn(
@@ -0,0 +1,191 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Reload new checkpoints into a live inference session."""
+from __future__ import print_function
+
+import threading
+
+import tensorflow as tf
+
+from . import model_helper
+from .utils import misc_utils as utils
+from .utils import quantize_utils
+
+__all__ = ["HotReloader"]
+
+
+class HotReloader(object):
+  """Watches a checkpoint dir and swaps new weights into a session.
+
+  Every variable of the graph gets a staged copy, outside of any collection.
+  A background thread loads new checkpoints of watch_dir into the staged
+  copies while the session keeps decoding with the live variables, and
+  swap() assigns them to the live variables in one session call.  The
+  decoding thread calls swap() between batches, so that a batch never sees
+  two checkpoints and no batch waits for a restore.
+
+  Like load_model, a full-rank checkpoint is factorized for an output_rank
+  graph, and float weights are quantized for the int8 variables of a
+  quantize_infer graph.  Checkpoints whose variables still don't match the
+  graph's are skipped; ones that can't be read, e.g. while being written,
+  are retried at the next check.
+
+  Must be created before the graph is finalized.
+  """
+
+  def __init__(self, graph, sess, ckpt, watch_dir, reload_secs=60):
+    self.sess = sess
+    self.ckpt = ckpt
+    self.watch_dir = watch_dir
+    self.reload_secs = reload_secs
+    self.num_reloads = 0
+    self._seen_ckpt = ckpt
+    self._staged_ckpt = None
+    self._lock = threading.Lock()
+    self._stop = threading.Event()
+
+    with graph.as_default(), tf.name_scope("staged"):
+      self._variables = graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
+      self._staged = [
+          tf.Variable(tf.zeros(v.shape, dtype=v.dtype.base_dtype),
+                      trainable=False, collections=[],
+                      name=v.op.name.replace("/", "_"))
+          for v in self._variables]
+      self._swap = tf.group(*[
+          v.assign(s) for v, s in zip(self._variables, self._staged)])
+
+    self._thread = threading.Thread(target=self._watch)
+    self._thread.daemon = True
+
+  def start(self):
+    self._thread.start()
+    return self
+
+  def _float_name(self, name):
+    """The name of the float weights an int8 variable or scale stores."""
+    for suffix in [quantize_utils.SCALE_SUFFIX, quantize_utils.INT8_SUFFIX]:
+      if name.endswith(suffix):
+        return name[:-len(suffix)]
+    return name
+
+  def _factorize(self, reader):
+    """Factors of the full-rank vocab_W of reader, if the graph needs them."""
+    shapes = dict((self._float_name(v.op.name), v.get_shape().as_list())
+                  for v in self._variables
+                  if not v.op.name.endswith(quantize_utils.SCALE_SUFFIX))
+    proj_names = [name for name in shapes
+                  if name.split("/")[-1] == "vocab_proj"]
+    if not proj_names:
+      return {}
+    proj_name = proj_names[0]
+    if (reader.has_tensor(proj_name) or
+        reader.has_tensor(proj_name + quantize_utils.INT8_SUFFIX)):
+      return {}
+    prefix = proj_name[:-len("vocab_proj")]
+    full_W = reader.get_tensor(prefix + "vocab_W")
+    rank = shapes[proj_name][1]
+    if prefix + "vocab_W" in shapes:
+      proj, vocab_W = model_helper.factorize_output(full_W, rank)
+      return {proj_name: proj, prefix + "vocab_W": vocab_W}
+    # Tied to the decoder embedding
+    embedding_name = [name for name in shapes
+                      if name.split("/")[-1] == "embedding_decoder"][0]
+    proj, _ = model_helper.factorize_output(
+        full_W, rank, reader.get_tensor(embedding_name))
+    return {proj_name: proj}
+
+  def _read(self, ckpt):
+    """The values of the graph's variables in ckpt, converted as needed.
+
+    Raises:
+      ValueError: if some variable can't be made from ckpt.
+    """
+    reader = tf.train.NewCheckpointReader(ckpt)
+    floats = self._factorize(reader)
+    quantized = {}
+    values, mismatched = [], []
+    for v in self._variables:
+      name = v.op.name
+      float_name = self._float_name(name)
+      value = floats.get(name)
+      if value is None and reader.has_tensor(name):
+        value = reader.get_tensor(name)
+      elif value is None and name != float_name:
+        # Quantize the float weights, e.g. of a training checkpoint
+        if float_name not in floats and reader.has_tensor(float_name):
+          floats[float_name] = reader.get_tensor(float_name)
+        if float_name in floats:
+          if float_name not in quantized:
+            quantized[float_name] = quantize_utils.quantize(
+                floats[float_name], quantize_utils.scale_axis(float_name))
+          weights, scales = quantized[float_name]
+          if name.endswith(quantize_utils.SCALE_SUFFIX):
+            value = scales
+          else:
+            value = weights
+      if value is None or list(value.shape) != v.get_shape().as_list():
+        mismatched.append(name)
+      values.append(value)
+    if mismatched:
+      raise ValueError("no match for %s" % ", ".join(mismatched))
+    return values
+
+  def _watch(self):
+    while not self._stop.wait(self.reload_secs):
+      ckpt = tf.train.latest_checkpoint(self.watch_dir)
+      if not ckpt or ckpt == self._seen_ckpt:
+        continue
+      try:
+        values = self._read(ckpt)
+      except ValueError as e:
+        utils.print_out("  can't reload %s: %s" % (ckpt, e))
+        self._seen_ckpt = ckpt
+        continue
+      except (tf.errors.OpError, IOError) as e:
+        utils.print_out("  can't read %s yet: %s" % (ckpt, e))
+        continue
+      with self._lock:
+        self._staged_ckpt = None
+        try:
+          for staged, value in zip(self._staged, values):
+            staged.load(value, self.sess)
+        except tf.errors.OpError as e:
+          utils.print_out("  can't reload %s: %s" % (ckpt, e))
+          continue
+        self._staged_ckpt = ckpt
+      self._seen_ckpt = ckpt
+
+  def swap(self):
+    """Make the last restored checkpoint live; returns the live one.
+
+    Doesn't wait for a restore in progress, the live weights are kept until
+    a later call.
+    """
+    if not self._lock.acquire(False):
+      return self.ckpt
+    try:
+      if self._staged_ckpt:
+        self.sess.run(self._swap)
+        self.ckpt = self._staged_ckpt
+        self._staged_ckpt = None
+        self.num_reloads += 1
+        utils.print_out("  reloaded %s" % self.ckpt)
+    finally:
+      self._lock.release()
+    return self.ckpt
+
+  def stop(self):
+    self._stop.set()
@@ -28,7 +28,8 @@ from . import model_helper
 from .utils import misc_utils as utils
 from .utils import nmt_utils
 
-__all__ = ["load_data", "inference",
+__all__ = ["load_data", "sort_by_length", "padding_efficiency",
+           "get_model_creator", "inference",
            "single_worker_inference", "multi_worker_inference"]
 
 
@@ -80,6 +81,45 @@ def load_data(inference_input_file, hparams=None):
   return inference_data
 
 
+def sort_by_length(inference_data, src_max_len=None):
+  """Sort lines by token count so batches hold sources of similar lengths.
+
+  Returns:
+    The sorted lines and their order: the sorted line i is
+    inference_data[order[i]].
+  """
+  lengths = [len(line.split()) for line in inference_data]
+  if src_max_len:
+    lengths = [min(length, src_max_len) for length in lengths]
+  order = sorted(range(len(inference_data)), key=lambda i: lengths[i])
+  return [inference_data[i] for i in order], order
+
+
+def padding_efficiency(inference_data, batch_size, src_max_len=None):
+  """Fraction of the padded source batches that are tokens."""
+  lengths = [len(line.split()) for line in inference_data]
+  if src_max_len:
+    lengths = [min(length, src_max_len) for length in lengths]
+  tokens, slots = 0, 0
+  for start in range(0, len(lengths), batch_size):
+    batch = lengths[start:start + batch_size]
+    tokens += sum(batch)
+    slots += len(batch) * max(batch)
+  return tokens / float(max(slots, 1))
+
+
+def get_model_creator(hparams):
+  """The model class of hparams' architecture."""
+  if not hparams.attention:
+    return nmt_model.Model
+  elif hparams.attention_architecture == "standard":
+    return attention_model.AttentionModel
+  elif hparams.attention_architecture in ["gnmt", "gnmt_v2"]:
+    return gnmt_model.GNMTModel
+  else:
+    raise ValueError("Unknown model architecture")
+
+
 def inference(ckpt,
               inference_input_file,
               inference_output_file,
@@ -91,14 +131,7 @@ def inference(ckpt,
   if hparams.inference_indices:
     assert num_workers == 1
 
-  if not hparams.attention:
-    model_creator = nmt_model.Model
-  elif hparams.attention_architecture == "standard":
-    model_creator = attention_model.AttentionModel
-  elif hparams.attention_architecture in ["gnmt", "gnmt_v2"]:
-    model_creator = gnmt_model.GNMTModel
-  else:
-    raise ValueError("Unknown model architecture")
+  model_creator = get_model_creator(hparams)
   infer_model = model_helper.create_infer_model(model_creator, hparams, scope)
 
   if num_workers == 1:
@@ -130,10 +163,23 @@ def single_worker_inference(infer_model,
   # Read data
   infer_data = load_data(inference_input_file, hparams)
 
+  # Decode sources of similar lengths together
+  order = None
+  if hparams.infer_sort_by_length and not hparams.inference_indices:
+    efficiency = padding_efficiency(
+        infer_data, hparams.infer_batch_size, hparams.src_max_len_infer)
+    infer_data, order = sort_by_length(infer_data, hparams.src_max_len_infer)
+    utils.print_out(
+        "  source padding efficiency %.1f%% in file order, %.1f%% sorted" %
+        (100 * efficiency, 100 * padding_efficiency(
+            infer_data, hparams.infer_batch_size,
+            hparams.src_max_len_infer)))
+
   with tf.Session(
       graph=infer_model.graph, config=utils.get_config_proto()) as sess:
     loaded_infer_model = model_helper.load_model(
         infer_model.model, ckpt, sess, "infer")
+    infer_model.graph.finalize()  # decoding must not add ops
     sess.run(
         infer_model.iterator.initializer,
         feed_dict={
@@ -153,7 +199,6 @@ def single_worker_inference(infer_model,
           subword_option=hparams.subword_option)
     else:
       nmt_utils.decode_and_evaluate(
-          hparams.src_max_len,
           "infer",
           loaded_infer_model,
           sess,
@@ -164,7 +209,9 @@ def single_worker_inference(infer_model,
           subword_option=hparams.subword_option,
           beam_width=hparams.beam_width,
           tgt_eos=hparams.eos,
-          num_translations_per_input=hparams.num_translations_per_input)
+          num_translations_per_input=hparams.num_translations_per_input,
+          num_latent_samples=hparams.num_latent_samples,
+          order=order)
 
 
 def multi_worker_inference(infer_model,
@@ -190,11 +237,17 @@ def multi_worker_inference(infer_model,
   start_position = jobid * load_per_worker
   end_position = min(start_position + load_per_worker, total_load)
   infer_data = infer_data[start_position:end_position]
+  order = list(range(start_position, end_position))
+  if hparams.infer_sort_by_length:
+    infer_data, sorted_order = sort_by_length(
+        infer_data, hparams.src_max_len_infer)
+    order = [order[i] for i in sorted_order]
 
   with tf.Session(
       graph=infer_model.graph, config=utils.get_config_proto()) as sess:
     loaded_infer_model = model_helper.load_model(
         infer_model.model, ckpt, sess, "infer")
+    infer_model.graph.finalize()  # decoding must not add ops
     sess.run(infer_model.iterator.initializer,
              {
                  infer_model.src_placeholder: infer_data,
@@ -208,11 +261,14 @@ def multi_worker_inference(infer_model,
         sess,
         output_infer,
         ref_file=None,
+        src_file=inference_input_file,
         metrics=hparams.metrics,
         subword_option=hparams.subword_option,
         beam_width=hparams.beam_width,
         tgt_eos=hparams.eos,
-        num_translations_per_input=hparams.num_translations_per_input)
+        num_translations_per_input=hparams.num_translations_per_input,
+        num_latent_samples=hparams.num_latent_samples,
+        order=order)
 
     # Change file name to indicate the file writing is completed.
     tf.gfile.Rename(output_infer, output_infer_done, overwrite=True)
@@ -19,20 +19,43 @@ from __future__ import division
 from __future__ import print_function
 
 import abc
+import math
+import os
 
 import tensorflow as tf
 
 from tensorflow.python.layers import core as layers_core
 
+from . import beam_search
 from . import model_helper
 from .utils import iterator_utils
 from .utils import misc_utils as utils
+from .utils import quantize_utils
+from .utils import vocab_utils
 from tensorflow.python.layers import base
 from tensorflow.python.ops import init_ops
 
+# Log-probability floor of the output distribution, log(1e-8).
+LOG_EPSILON = math.log(1e-8)
+# Log-probability of the words an output path leaves out, before the floor.
+LOG_ZERO = -1e9
+
+
+def log_add_epsilon(log_probs):
+  """log(exp(log_probs) + 1e-8), computed stably.
+
+  The log of the probabilities smoothed by 1e-8: values are floored at about
+  LOG_EPSILON, but unlike tf.maximum(log_probs, LOG_EPSILON) the result
+  still passes a gradient to log-probabilities below the floor.
+  """
+  return (tf.maximum(log_probs,LOG_EPSILON)+
+          tf.log1p(tf.exp(-tf.abs(log_probs-LOG_EPSILON))))
+
 
 class Output(base.Layer):
   def __init__(self, hparams,encoder_outputs,iterator,
+               shortlist=None,
+               embedding=None,
                activation=None,
                use_bias=True,
                kernel_initializer=None,
@@ -51,52 +74,286 @@ class Output(base.Layer):
     #get variable for dense layer
     with tf.variable_scope("build_network"):
         with tf.variable_scope("decoder/output_projection"):
-            if self.hparams.encoder_type=="bi":
+            if self.hparams.softmax_mode=="adaptive":
+                self._build_adaptive_softmax(initializer)
+            elif self.hparams.output_rank:
+                self._build_factorized_projection(initializer,embedding)
+            else:
                 self.vocab_W = tf.get_variable("vocab_W", [self.hparams.num_units+self.hparams.z_hidden_size,self.hparams.tgt_vocab_size],initializer=initializer)
-                self.copy_W = tf.get_variable("copy_W", [self.hparams.num_units*2,self.hparams.num_units+self.hparams.z_hidden_size,],initializer=initializer)
+            if self.hparams.softmax_mode!="adaptive":
                 self.vocab_b = tf.get_variable("vocab_b", [self.hparams.tgt_vocab_size],initializer=initializer)
+            if self.hparams.encoder_type=="bi":
+                self.copy_W = tf.get_variable("copy_W", [self.hparams.num_units*2,self.hparams.num_units+self.hparams.z_hidden_size,],initializer=initializer)
                 self.copy_b = tf.get_variable("copy_b", [self.hparams.num_units],initializer=initializer)
             else:
-                self.vocab_W = tf.get_variable("vocab_W", [self.hparams.num_units+self.hparams.z_hidden_size,self.hparams.tgt_vocab_size],initializer=initializer)
                 self.copy_W = tf.get_variable("copy_W", [self.hparams.num_units+self.hparams.z_hidden_size,self.hparams.num_units],initializer=initializer)
-                self.vocab_b = tf.get_variable("vocab_b", [self.hparams.tgt_vocab_size],initializer=initializer)
                 self.copy_b = tf.get_variable("copy_b", [self.hparams.num_units],initializer=initializer)
+    #copy keys and source mask only depend on the encoder, so they are built
+    #once per batch here rather than inside the decoding loop, where they
+    #would be recomputed at every step and for every beam
+    copy_h=tf.nn.tanh(quantize_utils.tensordot(self.encoder_outputs,self.copy_W))
+    self.copy_keys=tf.transpose(copy_h,[1,0,2])
+    #additive mask, large negative on source padding positions
+    source_mask=tf.sequence_mask(self.iterator.source_sequence_length,tf.shape(self.encoder_outputs)[0],dtype=tf.float32)
+    self.copy_mask=(source_mask-1)*1e9
+    self.shortlist=shortlist
+    if shortlist is not None:
+        #the shortlisted projection is gathered once per batch, and every
+        #target id is mapped to its shortlist column, or to a trailing
+        #LOG_ZERO column when it is not shortlisted
+        shortlist_size=tf.size(shortlist)
+        self.shortlist_W=quantize_utils.gather_columns(self.vocab_W,shortlist)
+        self.shortlist_b=tf.gather(self.vocab_b,shortlist)
+        positions=tf.scatter_nd(shortlist[:,None],tf.range(1,shortlist_size+1),[self.hparams.tgt_vocab_size])
+        self.shortlist_positions=tf.where(positions>0,positions-1,
+                                          tf.fill([self.hparams.tgt_vocab_size],shortlist_size))
+
+  def _build_factorized_projection(self, initializer, embedding):
+    """Variables of the low-rank target vocab projection.
+
+    Decoder outputs are first projected to output_rank dimensions by
+    vocab_proj, then to the vocabulary by vocab_W, which is the transposed
+    decoder embedding when tie_output_embedding is set.
+    """
+    units=self.hparams.num_units+self.hparams.z_hidden_size
+    rank=self.hparams.output_rank
+    self.vocab_proj = tf.get_variable("vocab_proj", [units,rank],initializer=initializer)
+    if self.hparams.tie_output_embedding:
+        self.vocab_W=tf.transpose(embedding)
+    else:
+        self.vocab_W = tf.get_variable("vocab_W", [rank,self.hparams.tgt_vocab_size],initializer=initializer)
+
+  def _project(self, inputs):
+    """Decoder outputs in the input space of vocab_W."""
+    if self.hparams.output_rank:
+        return quantize_utils.tensordot(inputs,self.vocab_proj)
+    return inputs
+
+  def _build_adaptive_softmax(self, initializer):
+    """Variables of the frequency-clustered (adaptive) target softmax.
+
+    Target words are ranked by their count in the training targets and split
+    at adaptive_softmax_cutoffs.  The head softmax scores the most frequent
+    words plus one token per tail cluster; every tail cluster first projects
+    the decoder output to a 4x smaller dimension than the previous cluster.
+    """
+    units=self.hparams.num_units+self.hparams.z_hidden_size
+    vocab_size=self.hparams.tgt_vocab_size
+    self.cutoffs=[c for c in self.hparams.adaptive_softmax_cutoffs if c<vocab_size]+[vocab_size]
+    order=vocab_utils.load_vocab_order(
+        os.path.join(self.hparams.out_dir,vocab_utils.VOCAB_ORDER_FILE))
+    rank=[0]*vocab_size
+    for i,word_id in enumerate(order):
+        rank[word_id]=i
+    #rank of every target id in the frequency order
+    self.vocab_rank=tf.constant(rank,dtype=tf.int32)
+    num_tails=len(self.cutoffs)-1
+    self.head_W = tf.get_variable("head_W", [units,self.cutoffs[0]+num_tails],initializer=initializer)
+    self.head_b = tf.get_variable("head_b", [self.cutoffs[0]+num_tails],initializer=initializer)
+    self.tail_proj,self.tail_W,self.tail_b=[],[],[]
+    for i in range(num_tails):
+        dim=max(units//4**(i+1),1)
+        size=self.cutoffs[i+1]-self.cutoffs[i]
+        self.tail_proj.append(tf.get_variable("tail_proj_%d"%i, [units,dim],initializer=initializer))
+        self.tail_W.append(tf.get_variable("tail_W_%d"%i, [dim,size],initializer=initializer))
+        self.tail_b.append(tf.get_variable("tail_b_%d"%i, [size],initializer=initializer))
+
   def build(self, input_shape):
     self.built=True
     
   def dense(self,inputs,W,b,active):
     return active(tf.tensordot(inputs,W,[[-1],[0]])+b)
 
-  def call(self, inputs,mode="infer"):
-    if mode=="infer":
-        inputs=tf.transpose(inputs,[1,0,2])
-    #calculate large vocabulary and source vocabulary logits
-    vocab_logits=tf.tensordot(inputs,self.vocab_W,[[-1],[0]])+self.vocab_b
-    copy_h=tf.nn.tanh(tf.tensordot(self.encoder_outputs,self.copy_W,[[-1],[0]]))
-    copy_h=tf.transpose(copy_h,[1,0,2])
-    copy_logits=tf.reduce_sum(inputs[:,:,None,:]*copy_h[None,:,:,:],-1)
-    #get large vocabulary and source vocabulary mask
-    source_weights = tf.sequence_mask(self.iterator.source_sequence_length,tf.shape(self.encoder_outputs)[0],dtype=tf.float32)-1
-    source_weights=tf.pad(source_weights,[[0,0],[self.hparams.tgt_vocab_size,0]])+1
-    #calculate large vocabulary and source vocabulary softmax
-    All_softmax=tf.nn.softmax(tf.concat([vocab_logits,copy_logits],-1))*source_weights[None,:,:]
-    All_softmax=All_softmax/tf.reduce_sum(All_softmax,-1)[:,:,None]
-    vocab_softmax=All_softmax[:,:,:self.hparams.tgt_vocab_size]
-    copy_softmax=All_softmax[:,:,self.hparams.tgt_vocab_size:]
-    #get output softmax, size=tgt_vocab_size+batch_size*src_max_len
-    length=self.hparams.batch_size*self.hparams.src_max_len
-    temp=tf.reshape(tf.range(length),[self.hparams.batch_size,self.hparams.src_max_len])[:tf.shape(inputs)[1]]
-    temp=tf.reduce_sum(tf.one_hot(temp,length),1)
-    copy_softmax=tf.pad(copy_softmax,tf.constant([[0,0],[0,self.hparams.batch_size],[0,self.hparams.src_max_len]]))[:,:self.hparams.batch_size,:self.hparams.src_max_len]
-    copy_softmax=temp[None,:,:]*tf.reshape(copy_softmax,[-1,length])[:,None,:]
-    P=tf.concat([vocab_softmax,copy_softmax],-1)+0.00000001 
+  def call(self, inputs,mode="infer",examples=None):
+    """Log-probabilities over the vocabulary and the copied source positions.
+
+    Vocab and copy scores are normalised together by a single log-softmax
+    over the vocabulary and the valid source positions, and smoothed by
+    log_add_epsilon like the probabilities of the former softmax path.  The
+    copy part is as wide as the batch's longest source.  In infer mode,
+    inputs are [batch, beam, units] or, for greedy decoding, [batch, units],
+    and examples optionally gives the batch indices of their rows when they
+    are a subset of the batch.
+    """
+    if mode=="infer" and inputs.shape.ndims==2:
+        return tf.squeeze(self.call(tf.expand_dims(inputs,1),mode,examples),[1])
+    copy_logits=self._copy_logits(inputs,mode,examples)
+    if self.hparams.softmax_mode=="adaptive":
+        log_probs=self._adaptive_log_probs(inputs,copy_logits,mode)
+    elif self.shortlist is not None and mode=="infer":
+        log_probs=self._shortlist_log_probs(inputs,copy_logits)
+    else:
+        #calculate large vocabulary and source vocabulary logits
+        vocab_logits=quantize_utils.tensordot(self._project(inputs),self.vocab_W)+self.vocab_b
+        log_probs=tf.nn.log_softmax(tf.concat([vocab_logits,copy_logits],-1))
+    #output log softmax, size=tgt_vocab_size+source length, where id
+    #tgt_vocab_size+j copies position j of the example's own source
+    return log_add_epsilon(log_probs)
+
+  def _copy_logits(self, inputs, mode, examples=None):
+    """Masked copy scores of every source position of the example."""
     if mode=="infer":
-        P=tf.transpose(P,[1,0,2])
-    return tf.log(P)
-    
-    
+        #beam search feeds batch-major [batch, beam, units]
+        copy_keys,copy_mask=self.copy_keys,self.copy_mask
+        if examples is not None:
+            copy_keys=tf.gather(copy_keys,examples)
+            copy_mask=tf.gather(copy_mask,examples)
+        copy_logits=tf.matmul(inputs,copy_keys,transpose_b=True)
+        return copy_logits+copy_mask[:,None,:]
+    #time-major [time, batch, units], copy scores are computed batch-major
+    copy_logits=tf.matmul(tf.transpose(inputs,[1,0,2]),self.copy_keys,transpose_b=True)
+    copy_logits+=self.copy_mask[:,None,:]
+    return tf.transpose(copy_logits,[1,0,2])
+
+  def _shortlist_log_probs(self, inputs, copy_logits):
+    """Log-probabilities with vocab scores computed on the shortlist only."""
+    vocab_logits=tf.tensordot(self._project(inputs),self.shortlist_W,[[-1],[0]])+self.shortlist_b
+    log_probs=tf.nn.log_softmax(tf.concat([vocab_logits,copy_logits],-1))
+    shortlist_size=tf.size(self.shortlist)
+    vocab_log_probs=tf.pad(log_probs[:,:,:shortlist_size],[[0,0],[0,0],[0,1]],constant_values=LOG_ZERO)
+    vocab_log_probs=tf.gather(vocab_log_probs,self.shortlist_positions,axis=2)
+    return tf.concat([vocab_log_probs,log_probs[:,:,shortlist_size:]],-1)
+
+  def _tail_logits(self, inputs, i):
+    hidden=tf.tensordot(inputs,self.tail_proj[i],[[-1],[0]])
+    return tf.tensordot(hidden,self.tail_W[i],[[-1],[0]])+self.tail_b[i]
+
+  def _adaptive_log_probs(self, inputs, copy_logits, mode):
+    """Adaptive softmax log-probabilities, in target id order, plus copies.
+
+    The copy positions are normalised together with the head cluster.  When
+    decoding, a tail cluster is only computed if the head gives it at least
+    adaptive_softmax_threshold probability somewhere in the batch; otherwise
+    its words get LOG_EPSILON.
+    """
+    head_size=self.cutoffs[0]
+    num_tails=len(self.cutoffs)-1
+    head_logits=tf.tensordot(inputs,self.head_W,[[-1],[0]])+self.head_b
+    head_log_probs=tf.nn.log_softmax(tf.concat([head_logits,copy_logits],-1))
+    vocab_log_probs=[head_log_probs[:,:,:head_size]]
+    for i in range(num_tails):
+        cluster_log_prob=head_log_probs[:,:,head_size+i:head_size+i+1]
+        def tail_fn(i=i,cluster_log_prob=cluster_log_prob):
+            return tf.nn.log_softmax(self._tail_logits(inputs,i))+cluster_log_prob
+        def floor_fn(i=i):
+            size=self.cutoffs[i+1]-self.cutoffs[i]
+            return tf.fill(tf.concat([tf.shape(inputs)[:-1],[size]],0),LOG_ZERO)
+        if mode=="infer":
+            vocab_log_probs.append(tf.cond(
+                tf.reduce_max(cluster_log_prob)>math.log(self.hparams.adaptive_softmax_threshold),
+                tail_fn,floor_fn))
+        else:
+            vocab_log_probs.append(tail_fn())
+    #back from frequency order to target id order
+    vocab_log_probs=tf.gather(tf.concat(vocab_log_probs,-1),self.vocab_rank,axis=2)
+    return tf.concat([vocab_log_probs,head_log_probs[:,:,head_size+num_tails:]],-1)
+
+  def crossent(self, inputs, labels, mode="train"):
+    """Cross entropy of labels computed from time-major decoder outputs."""
+    if self.hparams.softmax_mode=="adaptive":
+        return self.adaptive_crossent(inputs,labels)
+    if self.hparams.softmax_mode=="sampled" and mode=="train":
+        return self.sampled_crossent(inputs,labels)
+    return tf.nn.sparse_softmax_cross_entropy_with_logits(
+        labels=labels,logits=self(inputs,mode=mode))
+
+  def loss_dependencies(self):
+    """Tensors besides its inputs that crossent is differentiated through."""
+    if self.hparams.softmax_mode=="adaptive":
+        variables=[self.head_W,self.head_b]+self.tail_proj+self.tail_W+self.tail_b
+    else:
+        variables=[self.vocab_W,self.vocab_b]
+        if self.hparams.output_rank:
+            variables.append(self.vocab_proj)
+    return variables+[self.copy_keys]
+
+  def adaptive_crossent(self, inputs, labels):
+    """Adaptive softmax cross entropy.
+
+    Every target pays the head cross entropy of its word, cluster token or
+    copied position; a tail cluster is only scored for the targets that fall
+    into it.
+
+    Args:
+      inputs: time-major decoder outputs, [time, batch, units].
+      labels: ids of the copy-extended vocabulary, [time, batch].
+
+    Returns:
+      The cross entropy of every target word, [time, batch].
+    """
+    vocab_size=self.hparams.tgt_vocab_size
+    head_size=self.cutoffs[0]
+    num_tails=len(self.cutoffs)-1
+    is_copy=labels>=vocab_size
+    ranks=tf.gather(self.vocab_rank,tf.where(is_copy,tf.zeros_like(labels),labels))
+    #0 for the head, i+1 for tail cluster i
+    cluster=tf.zeros_like(ranks)
+    for i in range(num_tails):
+        cluster+=tf.to_int32(ranks>=self.cutoffs[i])
+    head_labels=tf.where(cluster>0,head_size+cluster-1,ranks)
+    head_labels=tf.where(is_copy,labels-vocab_size+head_size+num_tails,head_labels)
+    head_logits=tf.tensordot(inputs,self.head_W,[[-1],[0]])+self.head_b
+    crossent=tf.nn.sparse_softmax_cross_entropy_with_logits(
+        labels=head_labels,
+        logits=tf.concat([head_logits,self._copy_logits(inputs,"train")],-1))
+    for i in range(num_tails):
+        in_tail=tf.logical_and(tf.logical_not(is_copy),tf.equal(cluster,i+1))
+        indices=tf.where(in_tail)
+        tail_crossent=tf.nn.sparse_softmax_cross_entropy_with_logits(
+            labels=tf.gather_nd(ranks,indices)-self.cutoffs[i],
+            logits=self._tail_logits(tf.gather_nd(inputs,indices),i))
+        crossent+=tf.scatter_nd(indices,tail_crossent,tf.shape(crossent,out_type=tf.int64))
+    return crossent
+
+  def sampled_crossent(self, inputs, labels):
+    """Sampled-softmax cross entropy for training.
+
+    The vocabulary part of the softmax is restricted to the true word plus
+    num_sampled_softmax negatives drawn from a log-uniform distribution (the
+    vocab file is expected to be sorted by frequency) and corrected by their
+    expected counts.  The copy part keeps every valid source position.
+
+    Args:
+      inputs: time-major decoder outputs, [time, batch, units].
+      labels: ids of the copy-extended vocabulary, [time, batch].
+
+    Returns:
+      The cross entropy of every target word, [time, batch].
+    """
+    vocab_size=self.hparams.tgt_vocab_size
+    num_sampled=self.hparams.num_sampled_softmax
+    is_copy=labels>=vocab_size
+    copy_weights=tf.to_float(is_copy)
+    vocab_labels=tf.where(is_copy,tf.zeros_like(labels),labels)
+    sampled,true_expected,sampled_expected=tf.nn.log_uniform_candidate_sampler(
+        true_classes=tf.reshape(tf.to_int64(vocab_labels),[-1,1]),
+        num_true=1,
+        num_sampled=num_sampled,
+        unique=True,
+        range_max=vocab_size)
+    sampled=tf.to_int32(sampled)
+    vocab_W_t=tf.transpose(self.vocab_W)
+    projected=self._project(inputs)
+    #true word logits, [time, batch]; a copied word has no vocabulary entry
+    true_logits=tf.reduce_sum(projected*tf.nn.embedding_lookup(vocab_W_t,vocab_labels),-1)
+    true_logits+=tf.gather(self.vocab_b,vocab_labels)
+    true_logits-=tf.reshape(tf.log(true_expected),tf.shape(labels))
+    true_logits+=copy_weights*-1e9
+    #sampled negative logits, [time, batch, num_sampled]
+    sampled_W=tf.nn.embedding_lookup(vocab_W_t,sampled)
+    sampled_logits=tf.tensordot(projected,sampled_W,[[-1],[1]])
+    sampled_logits+=tf.gather(self.vocab_b,sampled)-tf.log(sampled_expected)
+    #remove accidental hits of the true word
+    hits=tf.to_float(tf.equal(vocab_labels[:,:,None],sampled[None,None,:]))
+    sampled_logits+=hits*(1-copy_weights)[:,:,None]*-1e9
+    logits=tf.concat([true_logits[:,:,None],sampled_logits,self._copy_logits(inputs,"train")],-1)
+    sampled_labels=tf.where(is_copy,labels-vocab_size+1+num_sampled,tf.zeros_like(labels))
+    return tf.nn.sparse_softmax_cross_entropy_with_logits(
+        labels=sampled_labels, logits=logits)
+
   def _compute_output_shape(self, input_shape):
-    return input_shape[:-1].concatenate(self.hparams.tgt_vocab_size+self.hparams.batch_size*self.hparams.src_max_len)
+    #the copy part depends on the source length of the batch
+    return input_shape[:-1].concatenate([None])
 
 
 
@@ -107,6 +364,79 @@ class Output(base.Layer):
 __all__ = ["BaseModel", "Model"]
 
 
+def sample_ids(log_probs, temperature, top_k=0, top_p=1.0, seed=None):
+  """Sample one id per row of log_probs [batch, num_ids].
+
+  The distribution is sharpened or flattened by temperature, then restricted
+  to its top_k most likely ids if top_k > 0, and to the smallest set of most
+  likely ids of probability at least top_p if top_p < 1.
+  """
+  logits = log_probs / temperature
+  neg_infs = tf.fill(tf.shape(logits), float("-inf"))
+  num_ids = tf.shape(logits)[-1]
+  if top_k > 0 or top_p < 1.0:
+    num_sorted = tf.minimum(top_k, num_ids) if top_k > 0 else num_ids
+    sorted_logits, _ = tf.nn.top_k(logits, num_sorted)
+    if top_p < 1.0:
+      # keep the ids before the cumulative probability reaches top_p
+      sorted_probs = tf.nn.softmax(sorted_logits)
+      before = tf.cumsum(sorted_probs, axis=-1, exclusive=True)
+      sorted_logits = tf.where(
+          before < top_p, sorted_logits,
+          tf.fill(tf.shape(sorted_logits), float("inf")))
+    threshold = tf.reduce_min(sorted_logits, -1, keep_dims=True)
+    logits = tf.where(logits < threshold, neg_infs, logits)
+  return tf.to_int32(tf.multinomial(logits, 1, seed=seed)[:, 0])
+
+
+class SamplingCopyHelper(tf.contrib.seq2seq.GreedyEmbeddingHelper):
+  """Feeds back ids sampled from the copy-extended output distribution."""
+
+  def __init__(self, embedding, start_tokens, end_token, temperature,
+               top_k=0, top_p=1.0, seed=None):
+    super(SamplingCopyHelper, self).__init__(
+        embedding, start_tokens, end_token)
+    self._temperature = temperature
+    self._top_k = top_k
+    self._top_p = top_p
+    self._seed = seed
+
+  def sample(self, time, outputs, state, name=None):
+    del time, state  # unused by sample
+    return sample_ids(outputs, self._temperature, self._top_k, self._top_p,
+                      self._seed)
+
+
+class GreedyCopyDecoder(tf.contrib.seq2seq.BasicDecoder):
+  """Greedy or sampling decoder over the copy-extended vocabulary.
+
+  Its rnn_output is the log-probability of every chosen id rather than the
+  whole output distribution, whose copy part has no static size.
+  """
+
+  @property
+  def output_size(self):
+    return tf.contrib.seq2seq.BasicDecoderOutput(
+        rnn_output=tf.TensorShape([]),
+        sample_id=self._helper.sample_ids_shape)
+
+  def step(self, time, inputs, state, name=None):
+    with tf.name_scope(name, "GreedyCopyDecoderStep", (time, inputs, state)):
+      cell_outputs, cell_state = self._cell(inputs, state)
+      log_probs = self._output_layer(cell_outputs)
+      sample_ids = self._helper.sample(
+          time=time, outputs=log_probs, state=cell_state)
+      (finished, next_inputs, next_state) = self._helper.next_inputs(
+          time=time,
+          outputs=log_probs,
+          state=cell_state,
+          sample_ids=sample_ids)
+      scores = tf.gather_nd(log_probs, tf.stack(
+          [tf.range(tf.shape(sample_ids)[0]), sample_ids], 1))
+    outputs = tf.contrib.seq2seq.BasicDecoderOutput(scores, sample_ids)
+    return (outputs, next_state, next_inputs, finished)
+
+
 class BaseModel(object):
   """Sequence-to-sequence base class.
   """
@@ -146,7 +476,7 @@ class BaseModel(object):
     self.num_layers = hparams.num_layers
     self.num_gpus = hparams.num_gpus
     self.time_major = hparams.time_major
-    self.src_max_len=hparams.src_max_len
+    self.output_time_chunk = hparams.output_time_chunk
     # extra_args: to make it flexible for adding external customizable code
     self.single_cell_fn = None
     if extra_args:
@@ -157,6 +487,12 @@ class BaseModel(object):
         hparams.init_op, hparams.random_seed, hparams.init_weight)
     tf.get_variable_scope().set_initializer(initializer)
 
+    # Int8 weights, exported by export.export_quantized_model
+    if (self.mode == tf.contrib.learn.ModeKeys.INFER and
+        hparams.quantize_infer):
+      tf.get_variable_scope().set_custom_getter(
+          quantize_utils.dequantizing_getter)
+
     # Embeddings
     self.init_embeddings(hparams, scope)
     self.batch_size = tf.size(self.iterator.source_sequence_length)
@@ -177,6 +513,9 @@ class BaseModel(object):
       self.infer_logits, _, self.final_context_state, self.sample_id = res
       self.sample_words = reverse_target_vocab_table.lookup(
           tf.to_int64(self.sample_id))
+      # Fetched by infer(), built once so that decoding adds no ops.
+      self.decoded_words = self._decoded_words()
+      self.copy_positions = self._copy_positions()
 
     if self.mode != tf.contrib.learn.ModeKeys.INFER:
       ## Count the number of predicted words for compute ppl.
@@ -362,13 +701,14 @@ class BaseModel(object):
       encoder_outputs, encoder_state = self._build_encoder(hparams)
 
       ## Decoder
-      logits, sample_id, final_context_state = self._build_decoder(
-          encoder_outputs, encoder_state, hparams)
+      (logits, decoder_cell_outputs, sample_id,
+       final_context_state) = self._build_decoder(
+           encoder_outputs, encoder_state, hparams)
 
       ## Loss
       if self.mode != tf.contrib.learn.ModeKeys.INFER:
         with tf.device(model_helper.get_device_str(num_layers - 1, num_gpus)):
-          loss = self._compute_loss(logits)
+          loss = self._compute_loss(logits, decoder_cell_outputs)
       else:
         loss = None
 
@@ -425,26 +765,21 @@ class BaseModel(object):
       hparams: The Hyperparameters configurations.
 
     Returns:
-      A tuple of final logits and final decoder state:
+      A tuple of final logits, decoder cell outputs, sample ids and final
+      decoder state:
         logits: size [time, batch_size, vocab_size] when time_major=True.
+        decoder_cell_outputs: the decoder outputs before the output layer,
+          only set when training with softmax_mode=sampled or for train and
+          eval with softmax_mode=adaptive or output_time_chunk > 0 (logits is
+          then a no-op), None otherwise.
     """
-    
-    encoder_emb_inp=tf.concat([self.encoder_emb_inp,encoder_outputs],-1)
-    embed_x=tf.pad(encoder_emb_inp,tf.constant([[0,hparams.batch_size],[0,hparams.src_max_len],[0,0]]))[:hparams.batch_size,:hparams.src_max_len,:]
-    if hparams.encoder_type=='bi':
-        embed_decoder=tf.reshape(embed_x,[hparams.batch_size*hparams.src_max_len,hparams.num_units*3])
-        temp=tf.pad(self.embedding_decoder,[[0,0],[0,hparams.num_units*2]])
-        embedding_decoder=tf.concat([temp,embed_decoder],0)
-    else:
-        embed_decoder=tf.reshape(embed_x,[hparams.batch_size*hparams.src_max_len,hparams.num_units*2])
-        temp=tf.pad(self.embedding_decoder,[[0,0],[0,hparams.num_units]])
-        embedding_decoder=tf.concat([temp,embed_decoder],0)
-    """
-    embed_x=tf.pad(self.encoder_emb_inp,tf.constant([[0,hparams.batch_size],[0,hparams.src_max_len],[0,0]]))[:hparams.batch_size,:hparams.src_max_len,:]
-    embed_decoder=tf.reshape(embed_x,[hparams.batch_size*hparams.src_max_len,hparams.num_units])
-    embedding_decoder=tf.concat([self.embedding_decoder,embed_decoder],0)
-    """
-    self.output_layer=Output(hparams,encoder_outputs,self.iterator)
+    self._build_copy_embedding(encoder_outputs, hparams)
+    shortlist = None
+    if self.mode == tf.contrib.learn.ModeKeys.INFER and hparams.shortlist_size:
+      shortlist = self._build_shortlist(hparams)
+    self.output_layer=Output(hparams,encoder_outputs,self.iterator,
+                             shortlist=shortlist,
+                             embedding=self.embedding_decoder)
     tgt_sos_id = tf.cast(self.tgt_vocab_table.lookup(tf.constant(hparams.sos)),
                          tf.int32)
     tgt_eos_id = tf.cast(self.tgt_vocab_table.lookup(tf.constant(hparams.eos)),
@@ -469,14 +804,10 @@ class BaseModel(object):
       if self.mode != tf.contrib.learn.ModeKeys.INFER:
         # decoder_emp_inp: [max_time, batch_size, num_units]
         target_input = iterator.target_input
-        binary=self.iterator.binary
-        shift=tf.range(tf.shape(target_input)[0])*self.src_max_len
-        shift=binary*shift[:,None]
-        target_input+=tf.pad(shift,tf.constant([[0,0],[1,0]]))
-    
         if self.time_major:
           target_input = tf.transpose(target_input)
-        decoder_emb_inp = tf.nn.embedding_lookup(embedding_decoder, target_input)
+        decoder_emb_inp = self._embed_decoder_ids(
+            target_input, batch_axis=1 if self.time_major else 0)
 
         # Helper
         helper = tf.contrib.seq2seq.TrainingHelper(
@@ -504,9 +835,20 @@ class BaseModel(object):
         # We chose to apply the output_layer to all timesteps for speed:
         #   10% improvements for small models & 20% for larger ones.
         # If memory is a concern, we should apply output_layer per timestep.
+        # With softmax_mode=sampled (training only) or adaptive, the loss skips
+        # the full projection and works on the cell outputs instead.  With
+        # output_time_chunk, the loss applies the output layer itself, a few
+        # time steps at a time.
         device_id = num_layers if num_layers < num_gpus else (num_layers - 1)
+        decoder_cell_outputs = None
         with tf.device(model_helper.get_device_str(device_id, num_gpus)):
-          if self.mode == tf.contrib.learn.ModeKeys.TRAIN:
+          if (hparams.output_time_chunk > 0 or
+              hparams.softmax_mode == "adaptive" or
+              (hparams.softmax_mode == "sampled" and
+               self.mode == tf.contrib.learn.ModeKeys.TRAIN)):
+            logits = tf.no_op()
+            decoder_cell_outputs = outputs.rnn_output
+          elif self.mode == tf.contrib.learn.ModeKeys.TRAIN:
               logits = self.output_layer(outputs.rnn_output,mode='train')
           else:
               logits = self.output_layer(outputs.rnn_output,mode='eval')
@@ -519,24 +861,51 @@ class BaseModel(object):
         end_token = tgt_eos_id
 
 
-        #print(tf.concat([self.embedding_decoder,embed_x],0))
+        if beam_width > 0 and hparams.compact_beam_search:
+          sample_id, final_context_state = beam_search.compact_beam_search(
+              cell,
+              lambda ids, examples: self._embed_decoder_ids(
+                  ids, batch_axis=0, examples=examples),
+              lambda outputs, examples: self.output_layer(
+                  outputs, examples=examples),
+              initial_state=decoder_initial_state,
+              start_tokens=start_tokens,
+              end_token=end_token,
+              beam_width=beam_width,
+              length_penalty_weight=length_penalty_weight,
+              maximum_iterations=maximum_iterations,
+              num_kept=hparams.num_translations_per_input,
+              output_time_major=self.time_major,
+              swap_memory=True)
+          return tf.no_op(), None, sample_id, final_context_state
+
         if beam_width > 0:
           my_decoder = tf.contrib.seq2seq.BeamSearchDecoder(
               cell=cell,
-              embedding=embedding_decoder,
+              embedding=lambda ids: self._embed_decoder_ids(ids, batch_axis=0),
               start_tokens=start_tokens,
               end_token=end_token,
               initial_state=decoder_initial_state,
               beam_width=beam_width,
               output_layer=self.output_layer,
               length_penalty_weight=length_penalty_weight)
+        elif hparams.sampling_temperature > 0:
+          helper = SamplingCopyHelper(
+              lambda ids: self._embed_decoder_ids(ids, batch_axis=0),
+              start_tokens, end_token,
+              temperature=hparams.sampling_temperature,
+              top_k=hparams.sampling_top_k,
+              top_p=hparams.sampling_top_p,
+              seed=hparams.random_seed)
         else:
-          # Helper
+          # Helper, feeding back copies through the copy-extended table
           helper = tf.contrib.seq2seq.GreedyEmbeddingHelper(
-              self.embedding_decoder, start_tokens, end_token)
+              lambda ids: self._embed_decoder_ids(ids, batch_axis=0),
+              start_tokens, end_token)
 
-          # Decoder
-          my_decoder = tf.contrib.seq2seq.BasicDecoder(
+        if beam_width == 0:
+          # Decoder, of the sampling or greedy helper
+          my_decoder = GreedyCopyDecoder(
               cell,
               helper,
               decoder_initial_state,
@@ -551,6 +920,7 @@ class BaseModel(object):
             swap_memory=True,
             scope=decoder_scope)
 
+        decoder_cell_outputs = None
         if beam_width > 0:
           logits = tf.no_op()
           sample_id = outputs.predicted_ids
@@ -558,7 +928,117 @@ class BaseModel(object):
           logits = outputs.rnn_output
           sample_id = outputs.sample_id
 
-    return logits, sample_id, final_context_state
+    return logits, decoder_cell_outputs, sample_id, final_context_state
+
+  def _build_shortlist(self, hparams):
+    """Target ids the inference vocab softmax is restricted to.
+
+    The shortlist of a batch is the union of the shortlist_size most
+    frequent target words, sos/eos/unk, and the lexicon candidates of every
+    source word of the batch.
+    """
+    frequent_ids, lexicon = vocab_utils.load_shortlist_lexicon(
+        os.path.join(hparams.out_dir, vocab_utils.SHORTLIST_LEXICON_FILE),
+        os.path.join(hparams.out_dir, vocab_utils.VOCAB_ORDER_FILE),
+        hparams.src_vocab_file,
+        hparams.tgt_vocab_file,
+        num_frequent=hparams.shortlist_size,
+        num_candidates=hparams.shortlist_lexicon_size,
+        special_words=[vocab_utils.UNK, hparams.sos, hparams.eos])
+    lexicon = tf.constant(lexicon, dtype=tf.int32)
+    candidates = tf.reshape(tf.gather(lexicon, self.iterator.source), [-1])
+    candidates = tf.boolean_mask(candidates, candidates >= 0)
+    shortlist, _ = tf.unique(
+        tf.concat([tf.constant(frequent_ids, dtype=tf.int32), candidates], 0))
+    return shortlist
+
+  def _tile_latent_samples(self, encoder_outputs, encoder_state, num_samples):
+    """Repeat every example of the batch num_samples times after encoding.
+
+    The encoder runs once per source, then every example becomes
+    num_samples consecutive examples that draw their own z and are decoded
+    together.  The iterator fields read by the decoder and the batch size
+    are replaced by their tiled versions.
+    """
+    def tile(tensor):
+      if not self.time_major:
+        return tf.contrib.seq2seq.tile_batch(tensor, num_samples)
+      tensor = tf.transpose(tensor, [1, 0, 2])
+      tensor = tf.contrib.seq2seq.tile_batch(tensor, num_samples)
+      return tf.transpose(tensor, [1, 0, 2])
+
+    encoder_outputs = tile(encoder_outputs)
+    self.encoder_emb_inp = tile(self.encoder_emb_inp)
+    encoder_state = tf.contrib.seq2seq.tile_batch(encoder_state, num_samples)
+    self.iterator = self.iterator._replace(
+        source=tf.contrib.seq2seq.tile_batch(
+            self.iterator.source, num_samples),
+        source_sequence_length=tf.contrib.seq2seq.tile_batch(
+            self.iterator.source_sequence_length, num_samples))
+    self.batch_size = tf.size(self.iterator.source_sequence_length)
+    return encoder_outputs, encoder_state
+
+  def _build_copy_embedding(self, encoder_outputs, hparams):
+    """Build the decoder embedding table of the copy-extended vocabulary.
+
+    Decoder ids below tgt_vocab_size are target words, id tgt_vocab_size + j
+    is a copy of position j of the example's own source sentence and is
+    embedded as that position's source embedding and encoder output.  Copy
+    rows are stored per example after a zero row, one row per position of
+    the batch's longest source, so the table is shaped by the runtime batch
+    size and source length.  Target words are looked up in embedding_decoder
+    and padded with zeros to the size of the copy rows.
+    """
+    copy_emb = tf.concat([self.encoder_emb_inp, encoder_outputs], -1)
+    if self.time_major:
+      copy_emb = tf.transpose(copy_emb, [1, 0, 2])
+    self.copy_source_len = tf.shape(copy_emb)[1]
+    if hparams.encoder_type == "bi":
+      self.copy_padding = hparams.num_units * 2
+    else:
+      self.copy_padding = hparams.num_units
+    copy_emb = tf.reshape(copy_emb,
+                          [-1, hparams.num_units + self.copy_padding])
+    self.copy_embedding_decoder = tf.pad(copy_emb, [[1, 0], [0, 0]])
+
+  def _embed_decoder_ids(self, ids, batch_axis, examples=None):
+    """Look up ids of the copy-extended vocabulary.
+
+    Args:
+      ids: int32 Tensor of decoder ids, tgt_vocab_size + j for copies.
+      batch_axis: the axis of `ids` that indexes the examples of the batch.
+      examples: batch indices of the examples along batch_axis, if they are
+        not the whole batch in order.
+
+    Returns:
+      The embeddings of `ids`, from `self.embedding_decoder` for target words
+      and from `self.copy_embedding_decoder` for copies.
+    """
+    if examples is None:
+      examples = tf.range(self.batch_size)
+    offset_shape = [1] * ids.shape.ndims
+    offset_shape[batch_axis] = -1
+    offset = tf.reshape(examples * self.copy_source_len, offset_shape)
+    is_copy = ids >= self.tgt_vocab_size
+    zeros = tf.zeros_like(ids)
+    # Only the rows of ids are gathered, and dequantized for int8 models;
+    # target words read the zero row of the copy table and copies row 0 of
+    # embedding_decoder, which are masked out.
+    target_emb = quantize_utils.embedding_lookup(
+        self.embedding_decoder, tf.where(is_copy, zeros, ids))
+    target_emb = tf.pad(target_emb,
+                        [[0, 0]] * ids.shape.ndims + [[0, self.copy_padding]])
+    # A copy past the batch's source length would read the row of another
+    # example.
+    copy_positions = tf.where(is_copy, ids - self.tgt_vocab_size, zeros)
+    check = tf.assert_less(
+        copy_positions, self.copy_source_len,
+        message="Copy id beyond the source length of the batch")
+    with tf.control_dependencies([check]):
+      copy_rows = tf.where(is_copy, copy_positions + offset + 1, zeros)
+    copy_emb = tf.nn.embedding_lookup(self.copy_embedding_decoder, copy_rows)
+    copy_mask = tf.expand_dims(tf.to_float(is_copy), -1)
+    return copy_mask * copy_emb + (1.0 - copy_mask) * target_emb
 
   def get_max_time(self, tensor):
     time_axis = 0 if self.time_major else 1
@@ -581,59 +1061,143 @@ class BaseModel(object):
     """
     pass
 
-  def _compute_loss(self, logits):
+  def _compute_loss(self, logits, decoder_cell_outputs):
     """Compute optimization loss."""
     kl_loss=tf.get_collection("kl_loss")
     target_output = self.iterator.target_output
-    
-    binary=self.iterator.binary
-    shift=tf.range(tf.shape(target_output)[0])*self.src_max_len
-    shift=binary*shift[:,None]
-    target_output+=tf.pad(shift,tf.constant([[0,0],[0,1]]))
-    
     if self.time_major:
       target_output = tf.transpose(target_output)
     max_time = self.get_max_time(target_output)
-    crossent = tf.nn.sparse_softmax_cross_entropy_with_logits(
-        labels=target_output, logits=logits)
     target_weights = tf.sequence_mask(
-        self.iterator.target_sequence_length, max_time, dtype=logits.dtype)
+        self.iterator.target_sequence_length, max_time, dtype=tf.float32)
     if self.time_major:
       target_weights = tf.transpose(target_weights)
+    mode = "train" if self.mode == tf.contrib.learn.ModeKeys.TRAIN else "eval"
+
+    if decoder_cell_outputs is not None and self.output_time_chunk > 0:
+      loss = self._compute_chunked_loss(
+          decoder_cell_outputs, target_output, target_weights, mode)
+      return loss / tf.to_float(self.batch_size)
+    if decoder_cell_outputs is not None:
+      crossent = self.output_layer.crossent(
+          decoder_cell_outputs, target_output, mode)
+    else:
+      crossent = tf.nn.sparse_softmax_cross_entropy_with_logits(
+          labels=target_output, logits=logits)
 
     loss = tf.reduce_sum(
         crossent * target_weights) / tf.to_float(self.batch_size)
     return loss
 
+  def _compute_chunked_loss(self, decoder_cell_outputs, target_output,
+                            target_weights, mode):
+    """Weighted cross entropy sum, output_time_chunk time steps at a time.
+
+    The output layer and the cross entropy run on one time chunk per
+    iteration of a while loop, so only one [chunk, batch, tgt_vocab_size +
+    source length] score tensor is live at a time.  The gradient of a while
+    loop would keep every chunk for the backward pass, so when training the
+    chunk gradients are also taken inside the loop, and the returned loss is
+    a surrogate whose value is the loss and whose gradients are the
+    accumulated chunk gradients.
+
+    Args:
+      decoder_cell_outputs: time-major decoder outputs before the output layer.
+      target_output: time-major target ids.
+      target_weights: time-major float mask of target_output.
+      mode: "train" or "eval".
+
+    Returns:
+      A scalar, the sum of the weighted cross entropy.
+    """
+    chunk = self.output_time_chunk
+    output_layer = self.output_layer
+    compute_gradients = self.mode == tf.contrib.learn.ModeKeys.TRAIN
+    dependencies = (output_layer.loss_dependencies()
+                    if compute_gradients else [])
+    max_time = tf.shape(decoder_cell_outputs)[0]
+    num_chunks = (max_time + chunk - 1) // chunk
+
+    def body(i, loss, output_grads, dependency_grads):
+      outputs = decoder_cell_outputs[i * chunk:(i + 1) * chunk]
+      crossent = output_layer.crossent(
+          outputs, target_output[i * chunk:(i + 1) * chunk], mode)
+      chunk_loss = tf.reduce_sum(
+          crossent * target_weights[i * chunk:(i + 1) * chunk])
+      if compute_gradients:
+        grads = tf.gradients(chunk_loss, [outputs] + dependencies)
+        output_grads = output_grads.write(i, grads[0])
+        dependency_grads = [
+            acc if grad is None else acc + tf.convert_to_tensor(grad)
+            for acc, grad in zip(dependency_grads, grads[1:])]
+      return i + 1, loss + chunk_loss, output_grads, dependency_grads
+
+    output_grads = tf.TensorArray(
+        tf.float32, size=num_chunks, infer_shape=False)
+    dependency_grads = [tf.zeros_like(d) for d in dependencies]
+    _, loss, output_grads, dependency_grads = tf.while_loop(
+        lambda i, *unused_args: i < num_chunks,
+        body,
+        [tf.constant(0), tf.constant(0.0), output_grads, dependency_grads],
+        parallel_iterations=1,
+        back_prop=False,
+        swap_memory=True)
+    if not compute_gradients:
+      return loss
+
+    # d(surrogate)/dx = grad for every (x, grad) pair, surrogate = loss.
+    linear = tf.add_n([
+        tf.reduce_sum(x * tf.stop_gradient(grad)) for x, grad in zip(
+            [decoder_cell_outputs] + dependencies,
+            [output_grads.concat()] + dependency_grads)])
+    return tf.stop_gradient(loss - linear) + linear
+
   def _get_infer_summary(self, hparams):
     return tf.no_op()
 
-  def infer(self, sess):
+  def infer(self, sess, feed_dict=None):
     assert self.mode == tf.contrib.learn.ModeKeys.INFER
     return sess.run([
-        self.infer_logits, self.infer_summary, tf.transpose(self.sample_id-tf.cast(self.tgt_vocab_table.size(),tf.int32),[2,1,0]), self.sample_words
-    ])
+        self.infer_logits, self.infer_summary, self.copy_positions,
+        self.decoded_words
+    ], feed_dict=feed_dict)
+
+  def _copy_positions(self):
+    """Decoded ids minus tgt_vocab_size, as [beam_width or 1, batch, time]."""
+    copy_positions = self.sample_id - tf.cast(self.tgt_vocab_table.size(),
+                                              tf.int32)
+    if self.time_major:
+      copy_positions = tf.transpose(
+          copy_positions, [1, 0, 2][:copy_positions.shape.ndims])
+    if copy_positions.shape.ndims == 2:  # greedy [batch, time]
+      return tf.expand_dims(copy_positions, 0)
+    return tf.transpose(copy_positions, [2, 0, 1])
+
+  def _decoded_words(self):
+    """sample_words as [batch, time], or [beam_width, batch, time]."""
+    sample_words = self.sample_words
+    if self.time_major:
+      perm = list(range(sample_words.shape.ndims))[::-1]
+      return tf.transpose(sample_words, perm)
+    if sample_words.shape.ndims == 3:
+      return tf.transpose(sample_words, [2, 0, 1])
+    return sample_words
 
-  def decode(self, sess):
+  def decode(self, sess, feed_dict=None):
     """Decode a batch.
 
     Args:
       sess: tensorflow session to use.
+      feed_dict: optional feeds, e.g. of num_latent_samples.
 
     Returns:
-      A tuple consiting of outputs, infer_summary.
-        outputs: of size [batch_size, time]
+      A tuple consiting of outputs, infer_summary, copy positions.
+        outputs: of size [batch_size, time], or [beam_width, batch_size,
+          time] when using beam search.
     """
-    _, infer_summary, sample_id, sample_words = self.infer(sess)
-
-    # make sure outputs is of shape [batch_size, time] or [beam_width,
-    # batch_size, time] when using beam search.
-    if self.time_major:
-      sample_words = sample_words.transpose()
-    elif sample_words.ndim == 3:  # beam search output in [batch_size,
-                                  # time, beam_width] shape.
-      sample_words = sample_words.transpose([2, 0, 1])
-    return sample_words, infer_summary,sample_id
+    _, infer_summary, copy_positions, sample_words = self.infer(
+        sess, feed_dict)
+    return sample_words, infer_summary, copy_positions
 
 
 class Model(BaseModel):
@@ -660,7 +1224,7 @@ class Model(BaseModel):
       dtype = scope.dtype
         
       # Look up embedding, emp_inp: [max_time, batch_size, num_units]
-      encoder_emb_inp = tf.nn.embedding_lookup(
+      encoder_emb_inp = quantize_utils.embedding_lookup(
           self.embedding_encoder, source)
       self.encoder_emb_inp=encoder_emb_inp
 
@@ -710,6 +1274,17 @@ class Model(BaseModel):
           encoder_state = tuple(encoder_state)
       else:
         raise ValueError("Unknown encoder_type %s" % hparams.encoder_type)
+    if self.mode == tf.contrib.learn.ModeKeys.INFER:
+      # Fetched and fed by encoder_cache, feeding them skips the encoder.
+      self.encoder_outputs = encoder_outputs
+      self.encoder_state = encoder_state
+    if (self.mode == tf.contrib.learn.ModeKeys.INFER and
+        (hparams.z_hidden_size > 0 or hparams.sampling_temperature > 0)):
+      # Fed to decode other numbers of samples with the same graph.
+      self.num_latent_samples = tf.placeholder_with_default(
+          hparams.num_latent_samples, shape=[], name="num_latent_samples")
+      encoder_outputs, encoder_state = self._tile_latent_samples(
+          encoder_outputs, encoder_state, self.num_latent_samples)
     if hparams.z_hidden_size==0:
         self.value=tf.constant(0.0)
         self.kl_loss=tf.constant(0.0)
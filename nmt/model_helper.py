@@ -2,13 +2,12 @@
 from __future__ import print_function
 
 import collections
+import os
 import time
 
 import numpy as np
 import tensorflow as tf
 
-from tensorflow.python.ops import lookup_ops
-
 from .utils import iterator_utils
 from .utils import misc_utils as utils
 from .utils import vocab_utils
@@ -18,7 +17,8 @@ __all__ = [
     "get_initializer", "get_device_str",
     "create_train_model", "create_eval_model", "create_infer_model",
     "create_emb_for_encoder_and_decoder", "create_rnn_cell",
-    "gradient_clip", "create_or_load_model", "load_model", "compute_perplexity"
+    "gradient_clip", "factorize_output", "create_or_load_model", "load_model",
+    "compute_perplexity"
 ]
 
 
@@ -251,17 +251,40 @@ class InferModel(
   pass
 
 
-def create_infer_model(model_creator, hparams, scope=None, extra_args=None):
-  """Create inference model."""
+def create_shortlist_files(hparams):
+  """Mine the shortlist lexicon and target frequency order if missing."""
+  src_file = "%s.%s" % (hparams.train_prefix, hparams.src)
+  tgt_file = "%s.%s" % (hparams.train_prefix, hparams.tgt)
+  order_file = os.path.join(hparams.out_dir, vocab_utils.VOCAB_ORDER_FILE)
+  lexicon_file = os.path.join(hparams.out_dir,
+                              vocab_utils.SHORTLIST_LEXICON_FILE)
+  if not tf.gfile.Exists(order_file):
+    vocab_utils.create_vocab_order(tgt_file, hparams.tgt_vocab_file,
+                                   order_file)
+  if not tf.gfile.Exists(lexicon_file):
+    utils.print_out("# Creating shortlist lexicon %s" % lexicon_file)
+    vocab_utils.create_shortlist_lexicon(src_file, tgt_file, lexicon_file)
+
+
+def create_infer_model(model_creator, hparams, scope=None, extra_args=None,
+                       embed_vocab=False):
+  """Create inference model.
+
+  With embed_vocab, the vocab tables hold the words as graph constants, for
+  graphs exported without the vocab files.
+  """
+  if hparams.shortlist_size:
+    create_shortlist_files(hparams)
   graph = tf.Graph()
   src_vocab_file = hparams.src_vocab_file
   tgt_vocab_file = hparams.tgt_vocab_file
 
   with graph.as_default(), tf.container(scope or "infer"):
     src_vocab_table, tgt_vocab_table = vocab_utils.create_vocab_tables(
-        src_vocab_file, tgt_vocab_file, hparams.share_vocab)
-    reverse_tgt_vocab_table = lookup_ops.index_to_string_table_from_file(
-        tgt_vocab_file, default_value=vocab_utils.UNK)
+        src_vocab_file, tgt_vocab_file, hparams.share_vocab,
+        embed=embed_vocab)
+    reverse_tgt_vocab_table = vocab_utils.create_reverse_vocab_table(
+        tgt_vocab_file, embed=embed_vocab)
 
     src_placeholder = tf.placeholder(shape=[None], dtype=tf.string)
     batch_size_placeholder = tf.placeholder(shape=[], dtype=tf.int64)
@@ -542,10 +565,110 @@ def gradient_clip(gradients, max_gradient_norm):
   return clipped_gradients, gradient_norm_summary, gradient_norm
 
 
+def factorize_output(full_W, rank, embedding=None):
+  """Factors of rank of a full [units, tgt_vocab_size] vocab_W.
+
+  Args:
+    full_W: the full-rank vocab_W.
+    rank: the output_rank.
+    embedding: with tie_output_embedding, the [tgt_vocab_size, rank] decoder
+      embedding, whose transpose is the factorized vocab_W.
+
+  Returns:
+    vocab_proj, [units, rank], and vocab_W, [rank, tgt_vocab_size], by
+    truncated SVD, or with an embedding, vocab_proj fitted by least squares
+    and None.
+  """
+  if embedding is not None:
+    return np.linalg.lstsq(embedding, full_W.T, rcond=None)[0].T, None
+  u, s, vt = np.linalg.svd(full_W, full_matrices=False)
+  proj = u[:, :rank] * s[:rank]
+  vocab_W = vt[:rank]
+  if vocab_W.shape[0] < rank:
+    proj = np.pad(proj, [[0, 0], [0, rank - proj.shape[1]]], "constant")
+    vocab_W = np.pad(vocab_W, [[0, rank - vocab_W.shape[0]], [0, 0]],
+                     "constant")
+  return proj, vocab_W
+
+
+def _restore_factorized_output(model, ckpt, session):
+  """Restore a full-rank checkpoint into a factorized output projection.
+
+  When ckpt has no vocab_proj, its [units, tgt_vocab_size] vocab_W is split
+  into vocab_proj and vocab_W of output_rank by truncated SVD, or, with
+  tie_output_embedding, vocab_proj is fitted by least squares to vocab_W and
+  the restored decoder embedding.  The optimizer slots of the factors are
+  initialized and other variables are restored as saved.  The saver and
+  initializer are built once per model and set of restored variables, so
+  repeated loads don't grow the graph.
+
+  Returns:
+    True if the model was restored, False if model and ckpt don't need it.
+
+  Raises:
+    ValueError: if other variables are missing from ckpt or saved with
+      another shape.
+  """
+  output_layer = getattr(model, "output_layer", None)
+  vocab_proj = getattr(output_layer, "vocab_proj", None)
+  if not isinstance(vocab_proj, tf.Variable):
+    return False
+  reader = tf.train.NewCheckpointReader(ckpt)
+  proj_name = vocab_proj.op.name
+  if reader.has_tensor(proj_name):
+    return False
+
+  tied = not isinstance(output_layer.vocab_W, tf.Variable)
+  factorized = [vocab_proj] if tied else [vocab_proj, output_layer.vocab_W]
+  factorized_names = set(v.op.name for v in factorized)
+  saved_shapes = reader.get_variable_to_shape_map()
+  restored, initialized, mismatched = [], [], []
+  for v in session.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES):
+    name = v.op.name
+    if name in factorized_names:
+      continue
+    if any(name.startswith(factor + "/") for factor in factorized_names):
+      initialized.append(v)  # optimizer slots of the factors
+    elif saved_shapes.get(name) == v.get_shape().as_list():
+      restored.append(v)
+    else:
+      mismatched.append("%s %s (%s in ckpt)" % (
+          name, v.get_shape().as_list(), saved_shapes.get(name, "missing")))
+  if mismatched:
+    raise ValueError("Can't restore %s into a factorized output model: %s" %
+                     (ckpt, ", ".join(mismatched)))
+  if not hasattr(model, "factorized_restorers"):
+    model.factorized_restorers = {}
+  key = tuple(v.op.name for v in restored)
+  if key not in model.factorized_restorers:
+    with session.graph.as_default():
+      model.factorized_restorers[key] = (
+          tf.train.Saver(restored), tf.variables_initializer(initialized))
+  saver, initializer = model.factorized_restorers[key]
+  saver.restore(session, ckpt)
+  session.run(initializer)
+
+  full_W = reader.get_tensor(
+      proj_name[:-len("vocab_proj")] + "vocab_W")
+  rank = vocab_proj.get_shape()[1].value
+  if tied:
+    # vocab_W is the transposed, restored decoder embedding.
+    embedding = session.run(output_layer.vocab_W).T
+    proj, _ = factorize_output(full_W, rank, embedding)
+  else:
+    proj, vocab_W = factorize_output(full_W, rank)
+    output_layer.vocab_W.load(vocab_W, session)
+  vocab_proj.load(proj, session)
+  utils.print_out("  factorized vocab_W of %s to rank %d" % (ckpt, rank))
+  return True
+
+
 def load_model(model, ckpt, session, name):
   start_time = time.time()
-  model.saver.restore(session, ckpt)
-  session.run(tf.tables_initializer())
+  if not _restore_factorized_output(model, ckpt, session):
+    model.saver.restore(session, ckpt)
+  # The initializers themselves, as tf.tables_initializer() adds an op.
+  session.run(session.graph.get_collection(tf.GraphKeys.TABLE_INITIALIZERS))
   utils.print_out(
       "  loaded %s model parameters from %s, time %.2fs" %
       (name, ckpt, time.time() - start_time))
@@ -0,0 +1,89 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for model.py."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from . import inference
+from . import model as nmt_model
+from . import model_helper
+from . import nmt
+
+VOCAB = ["<unk>", "<s>", "</s>", "select", "name", "from", "users", "where"]
+
+
+def create_test_hparams(out_dir, *args):
+  """Small model hparams with a test vocab, args as nmt.py flags."""
+  vocab_prefix = os.path.join(out_dir, "vocab")
+  for suffix in ["src", "tgt"]:
+    with open(vocab_prefix + "." + suffix, "w") as f:
+      f.write("\n".join(VOCAB) + "\n")
+  parser = argparse.ArgumentParser()
+  nmt.add_arguments(parser)
+  flags = parser.parse_args(
+      ["--src=src", "--tgt=tgt", "--vocab_prefix=" + vocab_prefix,
+       "--out_dir=" + out_dir, "--num_units=8", "--num_layers=2",
+       "--infer_batch_size=2"] + list(args))
+  return nmt.extend_hparams(nmt.create_hparams(flags))
+
+
+class ModelTest(tf.test.TestCase):
+
+  def _decode(self, hparams, sources):
+    infer_model = model_helper.create_infer_model(
+        inference.get_model_creator(hparams), hparams)
+    with self.test_session(graph=infer_model.graph) as sess:
+      sess.run(tf.global_variables_initializer())
+      sess.run(tf.tables_initializer())
+      sess.run(infer_model.iterator.initializer,
+               feed_dict={
+                   infer_model.src_placeholder: sources,
+                   infer_model.batch_size_placeholder: len(sources)
+               })
+      return infer_model.model.decode(sess)
+
+  def testLogAddEpsilon(self):
+    log_probs = tf.constant([0.0, -1.0, -18.0, -30.0, -1e9])
+    smoothed = nmt_model.log_add_epsilon(log_probs)
+    gradient = tf.gradients(smoothed, log_probs)[0]
+    with self.test_session() as sess:
+      smoothed, gradient = sess.run([smoothed, gradient])
+    expected = np.log(np.exp([0.0, -1.0, -18.0, -30.0, -1e9]) + 1e-8)
+    self.assertAllClose(expected, smoothed, rtol=1e-5)
+    # Below the floor, log-probabilities still get a gradient.
+    self.assertGreater(gradient[3], 0)
+
+  def testSamplingInferGraph(self):
+    hparams = create_test_hparams(
+        self.get_temp_dir(), "--beam_width=0", "--sampling_temperature=0.8",
+        "--sampling_top_k=4", "--sampling_top_p=0.9",
+        "--num_latent_samples=2")
+    words, _, copy_positions = self._decode(
+        hparams, ["select name from users", "select name"])
+    # Every source is decoded num_latent_samples times.
+    self.assertEqual(4, words.shape[0])
+    self.assertEqual((1,) + words.shape, copy_positions.shape)
+
+
+if __name__ == "__main__":
+  tf.test.main()
@@ -25,7 +25,10 @@ import sys
 import numpy as np
 import tensorflow as tf
 
+from . import export
 from . import inference
+from . import pool_inference
+from . import stream_inference
 from . import train
 from .utils import evaluation_utils
 from .utils import misc_utils as utils
@@ -193,6 +196,41 @@ def add_arguments(parser):
   parser.add_argument("--max_gradient_norm", type=float, default=5.0,
                       help="Clip gradients to this norm.")
   parser.add_argument("--batch_size", type=int, default=128, help="Batch size.")
+  parser.add_argument("--softmax_mode", type=str, default="full",
+                      help="""\
+      full | sampled | adaptive. With sampled, training scores the target
+      vocabulary only on num_sampled_softmax negatives plus the copy
+      distribution, eval and inference use the full softmax. With adaptive,
+      the target vocabulary is split by training frequency into a head and
+      reduced-dimension tail clusters.\
+      """)
+  parser.add_argument("--num_sampled_softmax", type=int, default=512,
+                      help="Number of sampled negatives for softmax_mode=sampled.")
+  parser.add_argument("--adaptive_softmax_cutoffs", type=str,
+                      default="2000,10000",
+                      help=("Comma-separated frequency ranks where the head and"
+                            " tail clusters of softmax_mode=adaptive end."))
+  parser.add_argument("--adaptive_softmax_threshold", type=float, default=1e-4,
+                      help=("Decoding skips an adaptive softmax tail cluster"
+                            " whose head probability is below this."))
+  parser.add_argument("--output_rank", type=int, default=0,
+                      help=("""\
+      If > 0, factorize the target vocab projection through this many
+      dimensions: decoder output -> output_rank -> vocab. Not used with
+      softmax_mode=adaptive.\
+      """))
+  parser.add_argument("--tie_output_embedding", type="bool", nargs="?",
+                      const=True, default=False,
+                      help=("""\
+      Use the transposed decoder embedding as the rank -> vocab part of the
+      factorized projection; output_rank defaults to num_units.\
+      """))
+  parser.add_argument("--output_time_chunk", type=int, default=0,
+                      help=("""\
+      If > 0, train and eval apply the output layer and the loss to this many
+      time steps at a time, so the scores of the whole target are never held
+      in memory at once.\
+      """))
 
   parser.add_argument("--steps_per_stats", type=int, default=100,
                       help=("How many training steps to do per stats logging."
@@ -243,6 +281,12 @@ def add_arguments(parser):
                             "(0-based) to decode."))
   parser.add_argument("--infer_batch_size", type=int, default=32,
                       help="Batch size for inference mode.")
+  parser.add_argument("--infer_sort_by_length", type="bool", nargs="?",
+                      const=True, default=True,
+                      help=("""\
+      Batch inference sources sorted by length, writing the outputs back in
+      input order.\
+      """))
   parser.add_argument("--inference_output_file", type=str, default=None,
                       help="Output file to store decoding results.")
   parser.add_argument("--inference_ref_file", type=str, default=None,
@@ -256,17 +300,100 @@ def add_arguments(parser):
       """))
   parser.add_argument("--length_penalty_weight", type=float, default=0.0,
                       help="Length penalty for beam search.")
+  parser.add_argument("--compact_beam_search", type="bool", nargs="?",
+                      const=True, default=False,
+                      help=("""\
+      Beam search that drops a sentence from the decoding batch once its
+      num_translations_per_input best finished hypotheses can't be beaten.
+      Not supported with attention.\
+      """))
+  parser.add_argument("--sampling_temperature", type=float, default=0.0,
+                      help=("""\
+      If > 0 and beam_width is 0, sample every next word, copies included,
+      from the output distribution at this temperature instead of taking the
+      most likely one.\
+      """))
+  parser.add_argument("--sampling_top_k", type=int, default=0,
+                      help=("If > 0, sample among the this many most likely"
+                            " words only."))
+  parser.add_argument("--sampling_top_p", type=float, default=1.0,
+                      help=("""\
+      If < 1, sample among the smallest set of most likely words whose
+      probability is at least this (nucleus sampling).\
+      """))
+  parser.add_argument("--shortlist_size", type=int, default=0,
+                      help=("""\
+      If > 0, decoding scores the target vocabulary only on a per-batch
+      shortlist: this many most frequent target words plus the lexicon
+      candidates of the batch's source words, mined from the training pairs
+      into out_dir.\
+      """))
+  parser.add_argument("--shortlist_lexicon_size", type=int, default=20,
+                      help="Shortlist lexicon candidates per source word.")
   parser.add_argument("--num_translations_per_input", type=int, default=1,
                       help=("""\
       Number of translations generated for each sentence. This is only used for
       inference.\
       """))
+  parser.add_argument("--num_latent_samples", type=int, default=1,
+                      help=("""\
+      Number of z samples decoded for each sentence, sharing one encoder pass,
+      or of sampled outputs with sampling_temperature > 0.  Every sample is
+      written, so each input gets num_latent_samples *
+      num_translations_per_input outputs. This is only used for inference.\
+      """))
+
+  # Export
+  parser.add_argument("--export_dir", type=str, default=None,
+                      help=("""\
+      If set, export the checkpoint (--ckpt, or the latest one in out_dir) as
+      an inference model to this directory instead of training.\
+      """))
+  parser.add_argument("--export_type", type=str, default="int8",
+                      help=("""\
+      int8: embeddings, output projections and LSTM kernels stored as int8
+      with per-row or per-unit float scales.
+      frozen: a pruned inference graph with weights and vocab tables as
+      constants, loaded by question_generator.FrozenQuestionGenerator.\
+      """))
 
   # Job info
   parser.add_argument("--jobid", type=int, default=0,
                       help="Task id of the worker.")
   parser.add_argument("--num_workers", type=int, default=1,
                       help="Number of workers (inference only).")
+  parser.add_argument("--num_local_workers", type=int, default=0,
+                      help=("""\
+      If > 1, decode with this many local worker processes, each pinned to
+      its own subset of the cores (inference only).\
+      """))
+  parser.add_argument("--infer_stream", type="bool", nargs="?", const=True,
+                      default=False,
+                      help=("""\
+      Read the inference input lazily, infer_chunk_size lines at a time, and
+      append the outputs of every chunk.  A restarted job resumes after the
+      last chunk written, recorded in inference_output_file.progress.  Local
+      workers always stream.\
+      """))
+  parser.add_argument("--generation_cache_dir", type=str, default=None,
+                      help=("""\
+      If set, streaming and local worker inference serve sources decoded
+      before with the same checkpoint and decoding settings from a cache
+      stored there.\
+      """))
+  parser.add_argument("--generation_cache_mb", type=int, default=1024,
+                      help="Size bound of the generation cache on disk.")
+  parser.add_argument("--encoder_cache_dir", type=str, default=None,
+                      help=("""\
+      If set, streaming and local worker inference cache the encoder outputs
+      and final states of sources there, and batches of sources encoded
+      before with the same checkpoint skip the encoder.\
+      """))
+  parser.add_argument("--encoder_cache_mb", type=int, default=1024,
+                      help="Size bound of the encoder state cache on disk.")
+  parser.add_argument("--infer_chunk_size", type=int, default=256,
+                      help=("Sentences read, or handed out to a local worker,"
+                            " at a time."))
   parser.add_argument("--num_inter_threads", type=int, default=0,
                       help="number of inter_op_parallelism_threads")
   parser.add_argument("--num_intra_threads", type=int, default=0,
@@ -313,6 +440,14 @@ def create_hparams(flags):
       optimizer=flags.optimizer,
       num_train_steps=flags.num_train_steps,
       batch_size=flags.batch_size,
+      softmax_mode=flags.softmax_mode,
+      num_sampled_softmax=flags.num_sampled_softmax,
+      adaptive_softmax_cutoffs=[
+          int(c) for c in flags.adaptive_softmax_cutoffs.split(",")],
+      adaptive_softmax_threshold=flags.adaptive_softmax_threshold,
+      output_rank=flags.output_rank,
+      tie_output_embedding=flags.tie_output_embedding,
+      output_time_chunk=flags.output_time_chunk,
       init_op=flags.init_op,
       init_weight=flags.init_weight,
       max_gradient_norm=flags.max_gradient_norm,
@@ -332,9 +467,18 @@ def create_hparams(flags):
       src_max_len_infer=flags.src_max_len_infer,
       tgt_max_len_infer=flags.tgt_max_len_infer,
       infer_batch_size=flags.infer_batch_size,
+      infer_sort_by_length=flags.infer_sort_by_length,
       beam_width=flags.beam_width,
       length_penalty_weight=flags.length_penalty_weight,
+      compact_beam_search=flags.compact_beam_search,
+      sampling_temperature=flags.sampling_temperature,
+      sampling_top_k=flags.sampling_top_k,
+      sampling_top_p=flags.sampling_top_p,
       num_translations_per_input=flags.num_translations_per_input,
+      shortlist_size=flags.shortlist_size,
+      shortlist_lexicon_size=flags.shortlist_lexicon_size,
+      num_latent_samples=flags.num_latent_samples,
+      quantize_infer=False,  # set by int8 exports.
 
       # Vocab
       sos=flags.sos if flags.sos else vocab_utils.SOS,
@@ -354,8 +498,8 @@ def create_hparams(flags):
       random_seed=flags.random_seed,
       override_loaded_hparams=flags.override_loaded_hparams,
       num_keep_ckpts=5,  # saves 5 checkpoints by default.
-      num_intra_threads=FLAGS.num_intra_threads,
-      num_inter_threads=FLAGS.num_inter_threads,
+      num_intra_threads=flags.num_intra_threads,
+      num_inter_threads=flags.num_inter_threads,
   )
 
 
@@ -372,6 +516,31 @@ def extend_hparams(hparams):
 
   if hparams.subword_option and hparams.subword_option not in ["spm", "bpe"]:
     raise ValueError("subword option must be either spm, or bpe")
+  if hparams.softmax_mode not in ["full", "sampled", "adaptive"]:
+    raise ValueError("Unknown softmax_mode %s" % hparams.softmax_mode)
+  if hparams.shortlist_size and hparams.softmax_mode == "adaptive":
+    raise ValueError("shortlist_size can't be used with adaptive softmax")
+  if hparams.tie_output_embedding:
+    if not hparams.output_rank:
+      hparams.output_rank = hparams.num_units
+    if hparams.output_rank != hparams.num_units:
+      raise ValueError("With tie_output_embedding, output_rank %d should be"
+                       " num_units %d" % (hparams.output_rank,
+                                          hparams.num_units))
+  if hparams.output_rank and hparams.softmax_mode == "adaptive":
+    raise ValueError("output_rank can't be used with adaptive softmax")
+  if hparams.compact_beam_search and hparams.attention:
+    raise ValueError("compact_beam_search can't be used with attention")
+  if hparams.sampling_temperature > 0 and hparams.beam_width > 0:
+    raise ValueError("sampling_temperature needs beam_width 0")
+  if not 0 < hparams.sampling_top_p <= 1:
+    raise ValueError("sampling_top_p %f should be in (0, 1]" %
+                     hparams.sampling_top_p)
+  if hparams.num_latent_samples > 1 and (
+      not (hparams.z_hidden_size or hparams.sampling_temperature > 0) or
+      hparams.attention_architecture in ["gnmt", "gnmt_v2"]):
+    raise ValueError("num_latent_samples needs a z_hidden_size > 0 model or"
+                     " sampling, with the uni or bi encoder")
 
   # Flags
   utils.print_out("# hparams:")
@@ -429,9 +598,18 @@ def extend_hparams(hparams):
         unk=vocab_utils.UNK)
   hparams.src_vocab_size=src_vocab_size
   hparams.tgt_vocab_size=tgt_vocab_size
+  if (hparams.softmax_mode == "sampled" and
+      hparams.num_sampled_softmax >= tgt_vocab_size):
+    raise ValueError("num_sampled_softmax %d should be < tgt_vocab_size %d" %
+                     (hparams.num_sampled_softmax, tgt_vocab_size))
   hparams.add_hparam("src_vocab_file", src_vocab_file)
   hparams.add_hparam("tgt_vocab_file", tgt_vocab_file)
 
+  if hparams.softmax_mode == "adaptive":
+    vocab_utils.create_vocab_order(
+        "%s.%s" % (hparams.train_prefix, hparams.tgt), tgt_vocab_file,
+        os.path.join(hparams.out_dir, vocab_utils.VOCAB_ORDER_FILE))
+
   # Pretrained Embeddings:
   hparams.add_hparam("src_embed_file", "")
   hparams.add_hparam("tgt_embed_file", "")
@@ -529,7 +707,13 @@ def run_main(flags, default_hparams, train_fn, inference_fn, target_session=""):
   hparams = create_or_load_hparams(
       out_dir, default_hparams, flags.hparams_path, save_hparams=(jobid==0))
 
-  if flags.inference_input_file:
+  if flags.export_dir:
+    # Export
+    ckpt = flags.ckpt
+    if not ckpt:
+      ckpt = tf.train.latest_checkpoint(out_dir)
+    export.export(flags.export_type, ckpt, flags.export_dir, hparams)
+  elif flags.inference_input_file:
     # Inference indices
     hparams.inference_indices = None
     if flags.inference_list:
@@ -541,8 +725,25 @@ def run_main(flags, default_hparams, train_fn, inference_fn, target_session=""):
     ckpt = flags.ckpt
     if not ckpt:
       ckpt = tf.train.latest_checkpoint(out_dir)
-    inference_fn(ckpt, flags.inference_input_file,
-                 trans_file, hparams, num_workers, jobid)
+    if flags.num_local_workers > 1:
+      pool_inference.pool_inference(
+          ckpt, flags.inference_input_file, trans_file, hparams,
+          flags.num_local_workers, flags.infer_chunk_size,
+          cache_dir=flags.generation_cache_dir,
+          cache_bytes=flags.generation_cache_mb * 2**20,
+          encoder_cache_dir=flags.encoder_cache_dir,
+          encoder_cache_bytes=flags.encoder_cache_mb * 2**20)
+    elif flags.infer_stream:
+      stream_inference.stream_inference(
+          ckpt, flags.inference_input_file, trans_file, hparams,
+          flags.infer_chunk_size,
+          cache_dir=flags.generation_cache_dir,
+          cache_bytes=flags.generation_cache_mb * 2**20,
+          encoder_cache_dir=flags.encoder_cache_dir,
+          encoder_cache_bytes=flags.encoder_cache_mb * 2**20)
+    else:
+      inference_fn(ckpt, flags.inference_input_file,
+                   trans_file, hparams, num_workers, jobid)
 
     # Evaluation
     ref_file = flags.inference_ref_file
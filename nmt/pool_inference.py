@@ -0,0 +1,178 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Inference with a pool of local worker processes.
+
+  python -m nmt.nmt --out_dir=model_dir --inference_input_file=queries.sql \\
+      --inference_output_file=questions.txt --num_local_workers=4
+
+The input is read in chunks of infer_chunk_size lines, handed out to the
+workers from a shared queue, and the outputs of the chunks are written in
+input order as soon as all previous chunks are done.
+"""
+from __future__ import print_function
+
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+
+import numpy as np
+import tensorflow as tf
+
+from . import stream_inference
+from .utils import misc_utils as utils
+
+__all__ = ["core_sets", "pool_inference"]
+
+
+def core_sets(num_workers):
+  """Split the cores this process may run on into num_workers subsets."""
+  if hasattr(os, "sched_getaffinity"):
+    cores = sorted(os.sched_getaffinity(0))
+  else:
+    cores = list(range(multiprocessing.cpu_count()))
+  if len(cores) < num_workers:
+    return [None] * num_workers
+  return [[int(c) for c in subset]
+          for subset in np.array_split(cores, num_workers)]
+
+
+def _worker(cores, hparams_values, ckpt, tasks, results, cache_dir,
+            cache_bytes, encoder_cache_dir, encoder_cache_bytes):
+  """Decode the chunks of tasks until a None, in a process of its own."""
+  if cores and hasattr(os, "sched_setaffinity"):
+    os.sched_setaffinity(0, cores)
+  hparams = tf.contrib.training.HParams(**hparams_values)
+  if cores:
+    hparams.num_intra_threads = len(cores)
+    hparams.num_inter_threads = 1
+  with stream_inference.create_generator(
+      ckpt, hparams, cache_dir, cache_bytes, encoder_cache_dir,
+      encoder_cache_bytes) as generator:
+    while True:
+      task = tasks.get()
+      if task is None:
+        break
+      chunk_id, sources = task
+      try:
+        results.put((chunk_id, generator.generate(sources), None))
+      except Exception:  # pylint: disable=broad-except
+        results.put((chunk_id, None, traceback.format_exc()))
+    if cache_dir:
+      utils.print_out("  worker %d cache %s" % (os.getpid(), generator.stats()))
+    elif encoder_cache_dir:
+      utils.print_out("  worker %d encoder cache %s" %
+                      (os.getpid(), generator.encoder_cache.stats()))
+
+
+def _feed(chunks, tasks, num_workers, num_chunks):
+  """Put the chunks, then a None per worker, on tasks; count them."""
+  count = 0
+  for chunk in chunks:
+    tasks.put((count, chunk))
+    count += 1
+  num_chunks.append(count)
+  for _ in range(num_workers):
+    tasks.put(None)
+
+
+def pool_inference(ckpt,
+                   inference_input_file,
+                   inference_output_file,
+                   hparams,
+                   num_workers,
+                   chunk_size,
+                   cache_dir=None,
+                   cache_bytes=2**30,
+                   encoder_cache_dir=None,
+                   encoder_cache_bytes=2**30):
+  """Decode inference_input_file with num_workers local processes.
+
+  Every worker is pinned to its own subset of the cores, runs intra-op
+  threads on it and loads the model in its own session.  The input is read
+  lazily and at most 2 chunks per worker wait in the queue.  Like
+  stream_inference, a restarted job resumes after the last chunk written,
+  and workers share the caches of cache_dir and encoder_cache_dir if set.
+  """
+  start_time = time.time()
+  marker = stream_inference.ProgressMarker(inference_output_file)
+  num_lines, output_bytes = marker.load()
+  if num_lines:
+    utils.print_out("# Resuming after %d lines of %s" %
+                    (num_lines, inference_input_file))
+  start_lines = num_lines
+
+  # Workers are spawned so that they don't inherit the parent's TF state.
+  context = multiprocessing.get_context("spawn")
+  tasks = context.Queue(maxsize=2 * num_workers)
+  results = context.Queue()
+  workers = []
+  for cores in core_sets(num_workers):
+    worker = context.Process(
+        target=_worker,
+        args=(cores, hparams.values(), ckpt, tasks, results, cache_dir,
+              cache_bytes, encoder_cache_dir, encoder_cache_bytes))
+    worker.daemon = True
+    worker.start()
+    workers.append(worker)
+  num_chunks = []
+  feeder = threading.Thread(
+      target=_feed,
+      args=(stream_inference.read_chunks(
+          inference_input_file, chunk_size, num_lines),
+            tasks, num_workers, num_chunks))
+  feeder.daemon = True
+  feeder.start()
+  utils.print_out("# Decoding chunks of %d sentences with %d workers" %
+                  (chunk_size, num_workers))
+
+  next_chunk = 0
+  done = False
+  try:
+    with stream_inference.open_output(
+        inference_output_file, output_bytes) as output_f:
+      pending = {}
+      while not num_chunks or next_chunk < num_chunks[0]:
+        try:
+          chunk_id, questions, error = results.get(timeout=1)
+        except queue.Empty:
+          if (not any(worker.is_alive() for worker in workers) and
+              not (num_chunks and next_chunk >= num_chunks[0])):
+            raise RuntimeError("Inference workers exited before the end")
+          continue
+        if error:
+          raise RuntimeError("Decoding chunk %d failed:\n%s" %
+                             (chunk_id, error))
+        pending[chunk_id] = questions
+        while next_chunk in pending:
+          questions = pending.pop(next_chunk)
+          num_lines += len(questions)
+          stream_inference.write_chunk(output_f, questions, marker, num_lines)
+          next_chunk += 1
+    done = True
+  finally:
+    for worker in workers:
+      if not done:
+        worker.terminate()
+      worker.join()
+  marker.remove()
+  utils.print_time(
+      "  done, num sentences %d, %.1f sentences/s" %
+      (num_lines, (num_lines - start_lines) /
+       max(time.time() - start_time, 1e-6)),
+      start_time)
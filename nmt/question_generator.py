@@ -0,0 +1,364 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Python API generating questions with a model kept in memory.
+
+  generator = QuestionGenerator("model_dir")
+  generator.generate(["select ...", ...], beam_width=5, num_samples=3)
+  # -> [["question", ...], ...], the questions of every query.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+
+import tensorflow as tf
+
+from tensorflow.python.util import nest
+
+from . import encoder_cache
+from . import generation_cache
+from . import hot_reload
+from . import inference
+from . import model_helper
+from . import nmt
+from .utils import misc_utils as utils
+from .utils import nmt_utils
+
+__all__ = ["load_model_hparams", "QuestionGenerator",
+           "FrozenQuestionGenerator"]
+
+# Files of a frozen export, see export.export_frozen_model.
+FROZEN_GRAPH_FILE = "frozen_model.pb"
+FROZEN_CONFIG_FILE = "frozen_model.json"
+# Decoding settings of the exported model kept with a frozen graph.
+FROZEN_HPARAMS = ("beam_width", "eos", "subword_option",
+                  "num_translations_per_input", "num_latent_samples",
+                  "infer_batch_size", "infer_sort_by_length",
+                  "src_max_len_infer")
+
+
+def load_model_hparams(model_dir, hparams_path=None):
+  """The saved hparams of model_dir, completed with the default ones."""
+  parser = argparse.ArgumentParser()
+  nmt.add_arguments(parser)
+  default_hparams = nmt.create_hparams(parser.parse_args([]))
+  hparams = utils.load_hparams(model_dir)
+  if not hparams:
+    raise ValueError("No hparams in %s" % model_dir)
+  return nmt.ensure_compatible_hparams(hparams, default_hparams, hparams_path)
+
+
+def _latent_samples_feed(hparams, num_samples, placeholder):
+  """num_samples, defaulted, and the feed_dict setting it if not None."""
+  if num_samples is None:
+    num_samples = hparams.num_latent_samples
+  if placeholder is not None:
+    return num_samples, {placeholder: num_samples}
+  if num_samples > 1:
+    raise ValueError("num_samples > 1 needs a z_hidden_size > 0 model or"
+                     " sampling")
+  return num_samples, None
+
+
+def _generate(sources, hparams, initialize, decode, beam_width, num_samples,
+              num_translations_per_input=None):
+  """Decode sources batch by batch, in length order if hparams says so.
+
+  initialize(sources) starts the iterator over sources and
+  decode(batch_sources) returns the words and copy positions of its next
+  batch, like model.decode, given the sources of that batch.
+  """
+  if num_translations_per_input is None:
+    num_translations_per_input = hparams.num_translations_per_input
+  sources = [source.strip() for source in sources]
+  order = list(range(len(sources)))
+  if hparams.infer_sort_by_length:
+    sources, order = inference.sort_by_length(
+        sources, hparams.src_max_len_infer)
+  initialize(sources)
+
+  questions = [None] * len(sources)
+  start = 0
+  while True:
+    try:
+      nmt_outputs, nmt_ids = decode(
+          sources[start:start + hparams.infer_batch_size])
+    except tf.errors.OutOfRangeError:
+      break
+    end = start + nmt_ids.shape[1] // num_samples
+    batch_translations = nmt_utils.get_translations(
+        nmt_outputs,
+        nmt_ids,
+        sources[start:end],
+        tgt_eos=hparams.eos,
+        subword_option=hparams.subword_option,
+        beam_width=beam_width,
+        num_translations_per_input=num_translations_per_input,
+        num_latent_samples=num_samples)
+    for i, translations in zip(order[start:end], batch_translations):
+      questions[i] = [t.decode("utf-8") for t in translations]
+    start = end
+  return questions
+
+
+class QuestionGenerator(object):
+  """Loads a checkpoint once and decodes lists of queries in memory.
+
+  An inference graph and its session are built on the first call with a
+  given beam_width and kept for later ones; num_samples is fed to the graph,
+  so it doesn't need a new one.  With a watch_dir, new checkpoints written
+  there are restored in the background and used from the next call on, see
+  hot_reload.HotReloader.  With an encoder_cache_dir, the encoder states of
+  sources are cached there and batches of cached sources skip the encoder,
+  see encoder_cache.  Not thread-safe.
+  """
+
+  def __init__(self, model_dir, ckpt=None, hparams=None, watch_dir=None,
+               reload_secs=60, encoder_cache_dir=None,
+               encoder_cache_bytes=2**30):
+    if hparams is None:
+      hparams = load_model_hparams(model_dir)
+    if not ckpt:
+      ckpt = tf.train.latest_checkpoint(watch_dir or model_dir)
+    self.hparams = hparams
+    self.ckpt = ckpt
+    self.watch_dir = watch_dir
+    self.reload_secs = reload_secs
+    self._models = {}
+    self.encoder_cache = None
+    if encoder_cache_dir:
+      self.encoder_cache = encoder_cache.EncoderStateCache(
+          encoder_cache_dir, encoder_cache_bytes)
+    self._fingerprint_ckpt = None
+    self._fingerprint = None
+
+  def _get_model(self, beam_width):
+    """The infer model and session of beam_width, built when first used."""
+    if beam_width not in self._models:
+      hparams = tf.contrib.training.HParams(**self.hparams.values())
+      hparams.beam_width = beam_width
+      infer_model = model_helper.create_infer_model(
+          inference.get_model_creator(hparams), hparams)
+      sess = tf.Session(
+          graph=infer_model.graph,
+          config=utils.get_config_proto(
+              num_intra_threads=hparams.num_intra_threads,
+              num_inter_threads=hparams.num_inter_threads))
+      model_helper.load_model(infer_model.model, self.ckpt, sess, "infer")
+      reloader = None
+      if self.watch_dir:
+        reloader = hot_reload.HotReloader(
+            infer_model.graph, sess, self.ckpt, self.watch_dir,
+            self.reload_secs)
+      infer_model.graph.finalize()  # decoding must not add ops
+      if reloader:
+        reloader.start()
+      self._models[beam_width] = (infer_model, sess, reloader)
+    return self._models[beam_width]
+
+  def reload(self, beam_width=None):
+    """Swap in the checkpoint last restored for beam_width, if any new."""
+    if beam_width is None:
+      beam_width = self.hparams.beam_width
+    _, _, reloader = self._get_model(beam_width)
+    if reloader:
+      self.ckpt = reloader.swap()
+    return self.ckpt
+
+  def generate(self, sources, beam_width=None, num_samples=None,
+               num_translations_per_input=None):
+    """Generate questions for a list of queries.
+
+    Args:
+      sources: the queries, in the tokenized form of the training data.
+      beam_width: defaults to the one of the model's hparams, 0 decodes
+        greedily.
+      num_samples: number of latent samples decoded per query, for models
+        with z_hidden_size > 0 or decoding with sampling_temperature > 0.
+        Defaults to hparams.num_latent_samples.
+      num_translations_per_input: number of best beam search hypotheses kept
+        per sample.  Defaults to hparams.num_translations_per_input.
+
+    Returns:
+      For every source, its num_samples * num_translations_per_input
+      questions as unicode strings, sample after sample.
+    """
+    hparams = self.hparams
+    if beam_width is None:
+      beam_width = hparams.beam_width
+    self.reload(beam_width)
+    infer_model, sess, _ = self._get_model(beam_width)
+    model = infer_model.model
+    num_samples, feed_dict = _latent_samples_feed(
+        hparams, num_samples, getattr(model, "num_latent_samples", None))
+
+    def initialize(sources):
+      sess.run(
+          infer_model.iterator.initializer,
+          feed_dict={
+              infer_model.src_placeholder: sources,
+              infer_model.batch_size_placeholder: hparams.infer_batch_size
+          })
+
+    def decode(unused_batch_sources):
+      nmt_outputs, _, nmt_ids = model.decode(sess, feed_dict)
+      return nmt_outputs, nmt_ids
+
+    if (not self.encoder_cache or
+        getattr(model, "encoder_outputs", None) is None):
+      return _generate(sources, hparams, initialize, decode, beam_width,
+                       num_samples, num_translations_per_input)
+
+    # Cached and uncached sources are decoded apart, so that every batch
+    # either skips the encoder or fills the cache.
+    questions = [None] * len(sources)
+    for indices, decode in self._encoder_cache_decoders(
+        sources, infer_model, sess, feed_dict):
+      if not indices:
+        continue
+      group_questions = _generate(
+          [sources[i] for i in indices], hparams, initialize, decode,
+          beam_width, num_samples, num_translations_per_input)
+      for i, source_questions in zip(indices, group_questions):
+        questions[i] = source_questions
+    return questions
+
+  def _encoder_cache_decoders(self, sources, infer_model, sess, feed_dict):
+    """Indices of the sources with cached encoder states and the others.
+
+    Returns (indices, decode) pairs for _generate: the cached sources are
+    decoded from their fed states, the others with the encoder, whose
+    outputs and states are fetched along and cached.
+    """
+    if self.ckpt != self._fingerprint_ckpt:
+      self._fingerprint_ckpt = self.ckpt
+      self._fingerprint = generation_cache.checkpoint_fingerprint(self.ckpt)
+    cache = self.encoder_cache
+    keys = dict(
+        (source.strip(), cache.key(source, self._fingerprint,
+                                   self.hparams.src_max_len_infer))
+        for source in sources)
+    cached = cache.lookup(keys[source.strip()] for source in sources)
+
+    model = infer_model.model
+    state_tensors = nest.flatten(model.encoder_state)
+    fetches = [model.decoded_words, model.copy_positions]
+
+    def decode_cached(batch_sources):
+      batch_feed = encoder_cache.batch_feed(
+          model.encoder_outputs, state_tensors,
+          [cached[keys[source]] for source in batch_sources],
+          self.hparams.time_major)
+      batch_feed.update(feed_dict or {})
+      return sess.run(fetches, feed_dict=batch_feed)
+
+    def decode_and_cache(batch_sources):
+      (nmt_outputs, nmt_ids, encoder_outputs, source_lengths,
+       encoder_states) = sess.run(
+           fetches + [model.encoder_outputs,
+                      infer_model.iterator.source_sequence_length,
+                      state_tensors],
+           feed_dict=feed_dict)
+      cache.put_many(zip(
+          [keys[source] for source in batch_sources],
+          encoder_cache.split_batch(encoder_outputs, encoder_states,
+                                    source_lengths, self.hparams.time_major)))
+      return nmt_outputs, nmt_ids
+
+    hits = [i for i, source in enumerate(sources)
+            if keys[source.strip()] in cached]
+    misses = [i for i, source in enumerate(sources)
+              if keys[source.strip()] not in cached]
+    return [(hits, decode_cached), (misses, decode_and_cache)]
+
+  def close(self):
+    """Close the sessions of every beam width and the encoder cache."""
+    for _, sess, reloader in self._models.values():
+      if reloader:
+        reloader.stop()
+      sess.close()
+    self._models = {}
+    if self.encoder_cache:
+      self.encoder_cache.close()
+      self.encoder_cache = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *unused_args):
+    self.close()
+
+
+class FrozenQuestionGenerator(object):
+  """Generates questions with a graph written by export --export_type=frozen.
+
+  Loading only imports the frozen graph and initializes its embedded vocab
+  tables, so the first decode comes without building the model in Python or
+  restoring a checkpoint.  The beam width is the one of the export.
+  """
+
+  def __init__(self, export_dir, num_intra_threads=0, num_inter_threads=0):
+    with tf.gfile.GFile(
+        os.path.join(export_dir, FROZEN_CONFIG_FILE), mode="r") as f:
+      config = json.loads(f.read())
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(
+        os.path.join(export_dir, FROZEN_GRAPH_FILE), mode="rb") as f:
+      graph_def.ParseFromString(f.read())
+    graph = tf.Graph()
+    with graph.as_default():
+      tf.import_graph_def(graph_def, name="")
+    self.hparams = tf.contrib.training.HParams(**config["hparams"])
+    self.tensors = config["tensors"]
+    self.sess = tf.Session(
+        graph=graph,
+        config=utils.get_config_proto(
+            num_intra_threads=num_intra_threads,
+            num_inter_threads=num_inter_threads))
+    self.sess.run(self.tensors["tables_initializer"])
+
+  def generate(self, sources, num_samples=None,
+               num_translations_per_input=None):
+    """QuestionGenerator.generate, at the beam width of the export."""
+    hparams = self.hparams
+    tensors = self.tensors
+    num_samples, feed_dict = _latent_samples_feed(
+        hparams, num_samples, tensors.get("num_latent_samples"))
+
+    def initialize(sources):
+      self.sess.run(
+          tensors["iterator_initializer"],
+          feed_dict={
+              tensors["src_placeholder"]: sources,
+              tensors["batch_size_placeholder"]: hparams.infer_batch_size
+          })
+
+    def decode(unused_batch_sources):
+      return self.sess.run(
+          [tensors["words"], tensors["copy_positions"]], feed_dict=feed_dict)
+
+    return _generate(sources, hparams, initialize, decode, hparams.beam_width,
+                     num_samples, num_translations_per_input)
+
+  def close(self):
+    self.sess.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *unused_args):
+    self.close()
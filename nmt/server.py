@@ -0,0 +1,331 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""HTTP server generating questions with a model kept in memory.
+
+  python -m nmt.server --out_dir=model_dir --port=8080
+
+  POST /generate  {"sources": ["select ...", ...]}
+    -> {"questions": [["...", ...], ...]}, the outputs of every source.
+  GET /stats -> request, batch, latency and throughput counters.
+
+Concurrent requests are decoded together in micro-batches of up to
+infer_batch_size sources, waiting at most max_batch_delay_ms for a batch
+to fill up.
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import sys
+import threading
+import time
+
+from http import server as http_server
+from socketserver import ThreadingMixIn
+
+import numpy as np
+import tensorflow as tf
+
+from . import hot_reload
+from . import inference
+from . import model_helper
+from . import nmt
+from .utils import misc_utils as utils
+from .utils import nmt_utils
+
+FLAGS = None
+
+# Number of most recent request latencies the percentiles are computed on.
+LATENCY_WINDOW = 10000
+
+
+def add_arguments(parser):
+  """Build ArgumentParser."""
+  nmt.add_arguments(parser)
+  parser.add_argument("--port", type=int, default=8080,
+                      help="Port to serve on.")
+  parser.add_argument("--max_batch_delay_ms", type=float, default=10.0,
+                      help=("Longest time a request waits for others to"
+                            " share its batch."))
+  parser.add_argument("--watch_ckpt_dir", type=str, default=None,
+                      help=("""\
+      If set, new checkpoints written to this dir, e.g. best_bleu, are
+      restored in the background and served from the next batch on.\
+      """))
+  parser.add_argument("--reload_secs", type=int, default=60,
+                      help="Seconds between checks for a new checkpoint.")
+
+
+class _Request(object):
+  """Sources of one request and, once decoded, their translations."""
+
+  def __init__(self, sources):
+    self.sources = sources
+    self.translations = None
+    self.error = None
+    self.start_time = time.time()
+    self.done = threading.Event()
+
+
+class BatchingTranslator(object):
+  """Decodes the sources of concurrent requests in micro-batches.
+
+  translate() may be called from any thread; a single decoding thread owns
+  the session and runs every batch with one iterator initialization and
+  one model.decode call.  With a hot_reload.HotReloader, a newly restored
+  checkpoint is swapped in between two batches.
+  """
+
+  def __init__(self, infer_model, sess, hparams, max_batch_size,
+               max_batch_delay, reloader=None):
+    self.infer_model = infer_model
+    self.sess = sess
+    self.hparams = hparams
+    self.reloader = reloader
+    self.max_batch_size = max_batch_size
+    self.max_batch_delay = max_batch_delay
+    self._queue = collections.deque()
+    self._lock = threading.Condition()
+    self._latencies = collections.deque(maxlen=LATENCY_WINDOW)
+    self._start_time = time.time()
+    self._num_requests = 0
+    self._num_sentences = 0
+    self._num_batches = 0
+    self._decode_time = 0.0
+    thread = threading.Thread(target=self._run)
+    thread.daemon = True
+    thread.start()
+
+  def translate(self, sources):
+    """The translations of every source, blocking until decoded.
+
+    Sources beyond max_batch_size are queued as several requests, so that
+    no batch exceeds it.
+    """
+    requests = [
+        _Request(sources[start:start + self.max_batch_size])
+        for start in range(0, len(sources), self.max_batch_size)]
+    if not requests:
+      return []
+    with self._lock:
+      self._queue.extend(requests)
+      self._lock.notify()
+    translations = []
+    for request in requests:
+      request.done.wait()
+      if request.error:
+        raise request.error
+      translations.extend(request.translations)
+    return translations
+
+  def _next_batch(self):
+    """Wait for requests and take up to max_batch_size sources of them."""
+    with self._lock:
+      while not self._queue:
+        self._lock.wait()
+      deadline = self._queue[0].start_time + self.max_batch_delay
+      while (sum(len(r.sources) for r in self._queue) < self.max_batch_size
+             and time.time() < deadline):
+        self._lock.wait(max(deadline - time.time(), 0))
+      batch = [self._queue.popleft()]
+      num_sources = len(batch[0].sources)
+      while (self._queue and num_sources + len(self._queue[0].sources) <=
+             self.max_batch_size):
+        num_sources += len(self._queue[0].sources)
+        batch.append(self._queue.popleft())
+    return batch
+
+  def _decode(self, sources):
+    hparams = self.hparams
+    self.sess.run(
+        self.infer_model.iterator.initializer,
+        feed_dict={
+            self.infer_model.src_placeholder: sources,
+            self.infer_model.batch_size_placeholder: len(sources)
+        })
+    nmt_outputs, _, nmt_ids = self.infer_model.model.decode(self.sess)
+    return nmt_utils.get_translations(
+        nmt_outputs,
+        nmt_ids,
+        sources,
+        tgt_eos=hparams.eos,
+        subword_option=hparams.subword_option,
+        beam_width=hparams.beam_width,
+        num_translations_per_input=hparams.num_translations_per_input,
+        num_latent_samples=hparams.num_latent_samples)
+
+  def _run(self):
+    while True:
+      batch = self._next_batch()
+      sources = [source for request in batch for source in request.sources]
+      if self.reloader:
+        self.reloader.swap()
+      start_time = time.time()
+      try:
+        translations = self._decode(sources) if sources else []
+      except Exception as e:  # pylint: disable=broad-except
+        translations, error = None, e
+      else:
+        error = None
+      end_time = time.time()
+
+      with self._lock:
+        self._num_batches += 1
+        self._num_requests += len(batch)
+        self._num_sentences += len(sources)
+        self._decode_time += end_time - start_time
+        for request in batch:
+          self._latencies.append(end_time - request.start_time)
+      for request in batch:
+        if error is not None:
+          request.error = error
+        else:
+          request.translations = [
+              [t.decode("utf-8") for t in ts]
+              for ts in translations[:len(request.sources)]]
+          translations = translations[len(request.sources):]
+        request.done.set()
+
+  def stats(self):
+    """Counters since start, latencies over the last LATENCY_WINDOW."""
+    with self._lock:
+      latencies = list(self._latencies)
+      uptime = time.time() - self._start_time
+      stats = {
+          "uptime_secs": uptime,
+          "requests": self._num_requests,
+          "sentences": self._num_sentences,
+          "batches": self._num_batches,
+          "mean_batch_size": (
+              self._num_sentences / float(max(self._num_batches, 1))),
+          "sentences_per_sec": self._num_sentences / max(uptime, 1e-6),
+          "decode_sentences_per_sec": (
+              self._num_sentences / max(self._decode_time, 1e-6)),
+          "queued_requests": len(self._queue),
+      }
+    if self.reloader:
+      stats["ckpt"] = self.reloader.ckpt
+      stats["reloads"] = self.reloader.num_reloads
+    if latencies:
+      stats["latency_p50_ms"] = 1000 * np.percentile(latencies, 50)
+      stats["latency_p99_ms"] = 1000 * np.percentile(latencies, 99)
+    return stats
+
+
+class _Handler(http_server.BaseHTTPRequestHandler):
+  """JSON endpoints of a BatchingTranslator."""
+
+  translator = None
+
+  def _reply(self, code, body):
+    data = json.dumps(body).encode("utf-8")
+    self.send_response(code)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    if self.path == "/stats":
+      self._reply(200, self.translator.stats())
+    else:
+      self._reply(404, {"error": "unknown path %s" % self.path})
+
+  def do_POST(self):  # pylint: disable=invalid-name
+    if self.path != "/generate":
+      self._reply(404, {"error": "unknown path %s" % self.path})
+      return
+    try:
+      length = int(self.headers.get("Content-Length", 0))
+      body = json.loads(self.rfile.read(length).decode("utf-8"))
+      sources = [source.strip() for source in body["sources"]]
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+      self._reply(400, {"error": "bad request: %s" % e})
+      return
+    try:
+      questions = self.translator.translate(sources)
+    except tf.errors.OpError as e:
+      self._reply(500, {"error": e.message})
+      return
+    except Exception as e:  # pylint: disable=broad-except
+      self._reply(500, {"error": "%s: %s" % (type(e).__name__, e)})
+      return
+    self._reply(200, {"questions": questions})
+
+  def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+    pass
+
+
+class _ThreadingServer(ThreadingMixIn, http_server.HTTPServer):
+  daemon_threads = True
+
+
+def serve(hparams, ckpt, port, max_batch_delay_ms, watch_dir=None,
+          reload_secs=60):
+  """Load the model of ckpt once and serve it until interrupted."""
+  infer_model = model_helper.create_infer_model(
+      inference.get_model_creator(hparams), hparams)
+  sess = tf.Session(
+      graph=infer_model.graph,
+      config=utils.get_config_proto(
+          num_intra_threads=hparams.num_intra_threads,
+          num_inter_threads=hparams.num_inter_threads))
+  model_helper.load_model(infer_model.model, ckpt, sess, "infer")
+  reloader = None
+  if watch_dir:
+    reloader = hot_reload.HotReloader(
+        infer_model.graph, sess, ckpt, watch_dir, reload_secs)
+  infer_model.graph.finalize()  # decoding must not add ops
+  if reloader:
+    reloader.start()
+
+  _Handler.translator = BatchingTranslator(
+      infer_model, sess, hparams,
+      max_batch_size=hparams.infer_batch_size,
+      max_batch_delay=max_batch_delay_ms / 1000.0,
+      reloader=reloader)
+  httpd = _ThreadingServer(("", port), _Handler)
+  utils.print_out("# Serving %s on port %d" % (ckpt, port))
+  try:
+    httpd.serve_forever()
+  finally:
+    httpd.server_close()
+    if reloader:
+      reloader.stop()
+    sess.close()
+
+
+def main(unused_argv):
+  default_hparams = nmt.create_hparams(FLAGS)
+  hparams = utils.load_hparams(FLAGS.out_dir)
+  if not hparams:
+    raise ValueError("No hparams in %s" % FLAGS.out_dir)
+  hparams = nmt.ensure_compatible_hparams(
+      hparams, default_hparams, FLAGS.hparams_path)
+  ckpt = FLAGS.ckpt
+  if not ckpt:
+    ckpt = tf.train.latest_checkpoint(FLAGS.watch_ckpt_dir or FLAGS.out_dir)
+  serve(hparams, ckpt, FLAGS.port, FLAGS.max_batch_delay_ms,
+        watch_dir=FLAGS.watch_ckpt_dir, reload_secs=FLAGS.reload_secs)
+
+
+if __name__ == "__main__":
+  server_parser = argparse.ArgumentParser()
+  add_arguments(server_parser)
+  FLAGS, unparsed = server_parser.parse_known_args()
+  nmt.FLAGS = FLAGS
+  tf.app.run(main=main, argv=[sys.argv[0]] + unparsed)
@@ -0,0 +1,156 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Streaming inference over input files of any size, resumable.
+
+  python -m nmt.nmt --out_dir=model_dir --inference_input_file=queries.sql \\
+      --inference_output_file=questions.txt --infer_stream
+
+The input is read infer_chunk_size lines at a time and the outputs of every
+chunk are appended to the output file.  After each chunk, the number of
+input lines done and the output size are saved to output_file.progress; a
+restarted job truncates the output to that size and skips those lines.
+"""
+from __future__ import print_function
+
+import codecs
+import io
+import itertools
+import json
+import os
+import time
+
+from . import generation_cache
+from . import question_generator
+from .utils import misc_utils as utils
+
+__all__ = ["read_chunks", "ProgressMarker", "open_output", "write_chunk",
+           "create_generator", "stream_inference"]
+
+PROGRESS_SUFFIX = ".progress"
+
+
+def read_chunks(inference_input_file, chunk_size, start_line=0):
+  """Lazily read the lines of a file from start_line, chunk_size at a time."""
+  with codecs.open(inference_input_file, "r", "utf-8") as f:
+    lines = (line.rstrip("\r\n")
+             for line in itertools.islice(f, start_line, None))
+    while True:
+      chunk = list(itertools.islice(lines, chunk_size))
+      if not chunk:
+        return
+      yield chunk
+
+
+class ProgressMarker(object):
+  """Input lines done and output bytes written so far, saved atomically."""
+
+  def __init__(self, inference_output_file):
+    self.path = inference_output_file + PROGRESS_SUFFIX
+
+  def load(self):
+    """(num_lines, output_bytes) of the last saved progress, or (0, 0)."""
+    if not os.path.exists(self.path):
+      return 0, 0
+    with open(self.path) as f:
+      progress = json.load(f)
+    return progress["num_lines"], progress["output_bytes"]
+
+  def save(self, num_lines, output_bytes):
+    tmp_path = self.path + ".tmp"
+    with open(tmp_path, "w") as f:
+      json.dump({"num_lines": num_lines, "output_bytes": output_bytes}, f)
+    os.rename(tmp_path, self.path)
+
+  def remove(self):
+    if os.path.exists(self.path):
+      os.remove(self.path)
+
+
+def open_output(inference_output_file, output_bytes):
+  """Open the output for appending after its first output_bytes bytes.
+
+  Anything written past output_bytes by an interrupted job is dropped.
+  """
+  if output_bytes:
+    output_f = io.open(inference_output_file, "r+b")
+    output_f.truncate(output_bytes)
+    output_f.seek(output_bytes)
+  else:
+    output_f = io.open(inference_output_file, "wb")
+  return output_f
+
+
+def write_chunk(output_f, questions, marker, num_lines):
+  """Append the questions of a chunk and save the progress made."""
+  output_f.write("".join(
+      t + "\n" for translations in questions
+      for t in translations).encode("utf-8"))
+  output_f.flush()
+  os.fsync(output_f.fileno())
+  marker.save(num_lines, output_f.tell())
+
+
+def create_generator(ckpt, hparams, cache_dir=None, cache_bytes=2**30,
+                     encoder_cache_dir=None, encoder_cache_bytes=2**30):
+  """A QuestionGenerator, behind a cache of cache_dir if set."""
+  generator = question_generator.QuestionGenerator(
+      None, ckpt=ckpt, hparams=hparams, encoder_cache_dir=encoder_cache_dir,
+      encoder_cache_bytes=encoder_cache_bytes)
+  if cache_dir:
+    generator = generation_cache.CachedQuestionGenerator(
+        generator, cache_dir=cache_dir, max_disk_bytes=cache_bytes)
+  return generator
+
+
+def stream_inference(ckpt,
+                     inference_input_file,
+                     inference_output_file,
+                     hparams,
+                     chunk_size,
+                     cache_dir=None,
+                     cache_bytes=2**30,
+                     encoder_cache_dir=None,
+                     encoder_cache_bytes=2**30):
+  """Decode inference_input_file chunk by chunk, resuming a previous run.
+
+  With a cache_dir, sources decoded before with the same checkpoint and
+  settings are served from the cache there.  With an encoder_cache_dir,
+  sources encoded before skip the encoder.
+  """
+  start_time = time.time()
+  marker = ProgressMarker(inference_output_file)
+  num_lines, output_bytes = marker.load()
+  if num_lines:
+    utils.print_out("# Resuming after %d lines of %s" %
+                    (num_lines, inference_input_file))
+  start_lines = num_lines
+
+  with create_generator(ckpt, hparams, cache_dir, cache_bytes,
+                        encoder_cache_dir,
+                        encoder_cache_bytes) as generator:
+    with open_output(inference_output_file, output_bytes) as output_f:
+      for chunk in read_chunks(inference_input_file, chunk_size, num_lines):
+        num_lines += len(chunk)
+        write_chunk(output_f, generator.generate(chunk), marker, num_lines)
+        utils.print_out("  %d lines done, %.1f sentences/s" %
+                        (num_lines, (num_lines - start_lines) /
+                         max(time.time() - start_time, 1e-6)))
+    if cache_dir:
+      utils.print_out("  cache %s" % generator.stats())
+    elif encoder_cache_dir:
+      utils.print_out("  encoder cache %s" % generator.encoder_cache.stats())
+  marker.remove()
+  utils.print_time("  done, num sentences %d" % num_lines, start_time)
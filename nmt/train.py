@@ -464,7 +464,6 @@ def _sample_decode(model, global_step, sess, hparams, iterator, src_data,
       translation = nmt_utils.get_translation(
           nmt_ids[0][0],
           src_data[decode_id],
-          hparams.src_max_len,
           nmt_outputs,
           sent_id=0,
           tgt_eos=hparams.eos,
@@ -491,7 +490,6 @@ def _external_eval(model, global_step, sess, hparams, iterator,
 
   output = os.path.join(out_dir, "output_%s" % label)
   scores = nmt_utils.decode_and_evaluate(
-      hparams.src_max_len,
       label,
       model,
       sess,
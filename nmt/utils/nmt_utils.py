@@ -24,11 +24,11 @@ import tensorflow as tf
 from ..utils import evaluation_utils
 from ..utils import misc_utils as utils
 
-__all__ = ["decode_and_evaluate", "get_translation"]
+__all__ = ["decode_and_evaluate", "get_translations", "format_translations",
+           "get_translation"]
 
 
-def decode_and_evaluate(src_maxlen,
-                        name,
+def decode_and_evaluate(name,
                         model,
                         sess,
                         trans_file,
@@ -39,8 +39,16 @@ def decode_and_evaluate(src_maxlen,
                         beam_width,
                         tgt_eos,
                         num_translations_per_input=1,
+                        num_latent_samples=1,
+                        order=None,
                         decode=True):
-  """Decode a test set and compute a score according to the evaluation task."""
+  """Decode a test set and compute a score according to the evaluation task.
+
+  With num_latent_samples > 1, the model decodes every source with that many
+  z samples, in consecutive rows, and all of them are written.  If the model
+  decodes the lines of src_file permuted, order[i] is the line of the i-th
+  decoded sentence, and translations are written back in line order.
+  """
   src_file=open(src_file,'r')
   src=[]
   for line in src_file:
@@ -55,32 +63,42 @@ def decode_and_evaluate(src_maxlen,
         tf.gfile.GFile(trans_file, mode="wb")) as trans_f:
       trans_f.write("")  # Write empty string to ensure file is created.
 
-      num_translations_per_input = max(
-          min(num_translations_per_input, beam_width), 1)
+      reordered = {}
       while True:
         try:
           nmt_outputs, _ ,nmt_ids= model.decode(sess)
-          if beam_width == 0:
-            nmt_outputs = np.expand_dims(nmt_outputs, 0)
-
-          batch_size = nmt_outputs.shape[1]
+          batch_size = nmt_ids.shape[1] // num_latent_samples
+          lines = range(num_sentences, num_sentences + batch_size)
+          if order is not None:
+            lines = [order[line] for line in lines]
           num_sentences += batch_size
 
-          for sent_id in range(batch_size):
-            for beam_id in range(num_translations_per_input):
-              translation = get_translation(
-                  nmt_ids[beam_id][sent_id],
-                  src[num_sentences-batch_size+sent_id],
-                  src_maxlen,
-                  nmt_outputs[beam_id],
-                  sent_id,
-                  tgt_eos=tgt_eos,
-                  subword_option=subword_option)
-              trans_f.write((translation + b"\n").decode("utf-8"))
+          batch_translations = get_translations(
+              nmt_outputs,
+              nmt_ids,
+              [src[line] for line in lines],
+              tgt_eos=tgt_eos,
+              subword_option=subword_option,
+              beam_width=beam_width,
+              num_translations_per_input=num_translations_per_input,
+              num_latent_samples=num_latent_samples)
+          for line, translations in zip(lines, batch_translations):
+            translations = "".join(
+                (translation + b"\n").decode("utf-8")
+                for translation in translations)
+            if order is None:
+              trans_f.write(translations)
+            else:
+              reordered[line] = translations
         except tf.errors.OutOfRangeError:
+          for line in sorted(reordered):
+            trans_f.write(reordered[line])
           utils.print_time(
               "  done, num sentences %d, num translations per input %d" %
-              (num_sentences, num_translations_per_input), start_time)
+              (num_sentences,
+               max(min(num_translations_per_input, beam_width), 1) *
+               num_latent_samples),
+              start_time)
           break
 
   # Evaluation
@@ -98,28 +116,107 @@ def decode_and_evaluate(src_maxlen,
   return evaluation_scores
 
 
-def get_translation(nmt_ids,src_data,maxlen,nmt_outputs, sent_id, tgt_eos, subword_option):
-  """Given batch decoding outputs, select a sentence and turn to text."""
-  if tgt_eos: tgt_eos = tgt_eos.encode("utf-8")
-  # Select a sentence
-  src_data=src_data.split(' ')
-  output = nmt_outputs[sent_id, :].tolist()
-  assert len(output)==len(nmt_ids)
-  for i in range(len(nmt_ids)):
-    if nmt_ids[i]>=0:
-        index=nmt_ids[i]%maxlen
-        if index<len(src_data):
-            output[i]=bytes(src_data[index], encoding = "utf8") 
-        
-  # If there is an eos symbol in outputs, cut them at that point.
-  if tgt_eos and tgt_eos in output:
-    output = output[:output.index(tgt_eos)]
-
-  if subword_option == "bpe":  # BPE
-    translation = utils.format_bpe_text(output)
-  elif subword_option == "spm":  # SPM
-    translation = utils.format_spm_text(output)
-  else:
-    translation = utils.format_text(output)
-
-  return translation
+def get_translations(nmt_outputs, nmt_ids, src, tgt_eos, subword_option,
+                     beam_width, num_translations_per_input=1,
+                     num_latent_samples=1):
+  """Turn a batch decoded by model.decode into text.
+
+  Args:
+    nmt_outputs: the decoded words.
+    nmt_ids: the decoded ids minus tgt_vocab_size.
+    src: the source sentence of every input of the batch.
+
+  Returns:
+    The translations of every source, num_latent_samples times the
+    num_translations_per_input best ones.
+  """
+  if beam_width == 0:
+    nmt_outputs = np.expand_dims(nmt_outputs, 0)
+  num_translations_per_input = max(
+      min(num_translations_per_input, beam_width), 1)
+  texts = format_translations(
+      nmt_outputs[:num_translations_per_input],
+      nmt_ids[:num_translations_per_input],
+      src,
+      tgt_eos=tgt_eos,
+      subword_option=subword_option,
+      rows_per_source=num_latent_samples)
+  return [
+      [texts[beam_id][row]
+       for row in range(sent_id * num_latent_samples,
+                        (sent_id + 1) * num_latent_samples)
+       for beam_id in range(num_translations_per_input)]
+      for sent_id in range(len(src))]
+
+
+def _source_words(src):
+  """Encoded words of every source, padded, and the number of words."""
+  words = [sentence.split(" ") for sentence in src]
+  lengths = np.array([len(sentence) for sentence in words], dtype=np.int64)
+  table = np.full([len(words), max([1] + lengths.tolist())], b"",
+                  dtype=object)
+  for i, sentence in enumerate(words):
+    table[i, :len(sentence)] = [word.encode("utf-8") for word in sentence]
+  return table, lengths
+
+
+def format_translations(nmt_outputs, nmt_ids, src, tgt_eos, subword_option,
+                        rows_per_source=1):
+  """Turn decoded words of many beams and rows into text at once.
+
+  Copies are resolved, sentences cut at tgt_eos and subwords joined on whole
+  [beam, rows, time] arrays; only the final join is done per sentence.
+
+  Args:
+    nmt_outputs: [beam, rows, time] decoded words.
+    nmt_ids: [beam, rows, time] decoded ids minus tgt_vocab_size, where a
+      non-negative id is the position of the copied word in the row's source.
+    src: the source sentences, row r decoding src[r // rows_per_source].
+
+  Returns:
+    The [beam][row] translations as byte strings.
+  """
+  words = np.asarray(nmt_outputs, dtype=object)
+  nmt_ids = np.asarray(nmt_ids)
+  table, lengths = _source_words(src)
+  sources = (np.arange(words.shape[1]) // rows_per_source)[None, :, None]
+  copied = (nmt_ids >= 0) & (nmt_ids < lengths[sources])
+  words = np.where(
+      copied, table[sources, np.clip(nmt_ids, 0, table.shape[1] - 1)], words)
+
+  # Cut sentences at their first eos.
+  num_words = np.full(words.shape[:2], words.shape[2], dtype=np.int64)
+  if tgt_eos:
+    eos = words == tgt_eos.encode("utf-8")
+    num_words = np.where(eos.any(-1), eos.argmax(-1), num_words)
+
+  texts = []
+  for beam_words, beam_num_words in zip(words, num_words):
+    beam_texts = []
+    for row_words, row_num_words in zip(beam_words, beam_num_words):
+      output = row_words[:row_num_words].tolist()
+      if subword_option == "bpe":  # BPE
+        text = utils.format_text(output).replace(b"@@ ", b"")
+        if text.endswith(b"@@"):  # drop an unfinished last word
+          text = text.rsplit(b" ", 1)[0] if b" " in text else b""
+      elif subword_option == "spm":  # SPM
+        text = utils.format_spm_text(output)
+      else:
+        text = utils.format_text(output)
+      beam_texts.append(text)
+    texts.append(beam_texts)
+  return texts
+
+
+def get_translation(nmt_ids,src_data,nmt_outputs, sent_id, tgt_eos, subword_option):
+  """Given batch decoding outputs, select a sentence and turn to text.
+
+  nmt_ids holds the decoded ids minus tgt_vocab_size, so a non-negative id is
+  the position of the copied word in the sentence's own source.
+  """
+  return format_translations(
+      nmt_outputs[None, sent_id:sent_id + 1, :],
+      np.asarray(nmt_ids)[None, None, :],
+      [src_data],
+      tgt_eos=tgt_eos,
+      subword_option=subword_option)[0][0]
@@ -0,0 +1,154 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Int8 weight quantization for CPU inference."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+import weakref
+
+import numpy as np
+import tensorflow as tf
+
+__all__ = ["is_quantized", "scale_axis", "quantize", "dequantizing_getter",
+           "embedding_lookup", "tensordot", "gather_columns"]
+
+# Matrices stored as int8 by quantized inference models.
+QUANTIZED_VARIABLES = ("embedding_encoder", "embedding_decoder",
+                       "vocab_W", "vocab_proj", "copy_W", "kernel")
+EMBEDDING_VARIABLES = ("embedding_encoder", "embedding_decoder")
+INT8_SUFFIX = "_int8"
+SCALE_SUFFIX = "_int8_scale"
+
+# The int8 weights, scales and float weights of every dequantized matrix, by
+# graph and name of the dequantized tensor.
+_QUANTIZED_PARTS = weakref.WeakKeyDictionary()
+
+
+def is_quantized(name, shape):
+  """Whether the variable `name` of `shape` is stored as int8."""
+  shape = tf.TensorShape(shape)
+  return (shape.ndims == 2 and shape.is_fully_defined() and
+          name.split("/")[-1] in QUANTIZED_VARIABLES)
+
+
+def scale_axis(name):
+  """The axis a scale is shared along.
+
+  Embeddings get one scale per row (word), projections and LSTM kernels one
+  scale per output unit (column).
+  """
+  return 1 if name.split("/")[-1] in EMBEDDING_VARIABLES else 0
+
+
+def quantize(weights, axis):
+  """Symmetric int8 quantization of a float matrix.
+
+  Returns:
+    int8 weights and the float32 scales, with `axis` kept as size 1, so that
+    weights * scales approximates the input.
+  """
+  scales = np.max(np.abs(weights), axis=axis, keepdims=True) / 127.0
+  scales[scales == 0] = 1.0
+  quantized = np.clip(np.round(weights / scales), -127, 127)
+  return quantized.astype(np.int8), scales.astype(np.float32)
+
+
+def dequantizing_getter(getter, name, *args, **kwargs):
+  """Custom getter storing quantized matrices as int8 weights plus scales.
+
+  The model sees the float matrix rebuilt from the int8 variable name_int8
+  and the scale variable name_int8_scale, written by quantize at export.
+  The conversion is built outside of any while loop, e.g. of the LSTM
+  kernels created by dynamic_rnn, so that it runs once per session run
+  rather than at every decoding step.  embedding_lookup and gather_columns
+  given that matrix only convert the rows or columns they gather, and
+  tensordot applies the scales to the product.
+  """
+  shape = kwargs.get("shape")
+  if shape is None or not is_quantized(name, shape):
+    return getter(name, *args, **kwargs)
+  shape = tf.TensorShape(shape).as_list()
+  scale_shape = [1, shape[1]] if scale_axis(name) == 0 else [shape[0], 1]
+  kwargs.update(trainable=False, partitioner=None, regularizer=None)
+  kwargs.update(dtype=tf.int8, initializer=tf.zeros_initializer())
+  weights = getter(name + INT8_SUFFIX, *args, **kwargs)
+  kwargs.update(shape=scale_shape, dtype=tf.float32,
+                initializer=tf.ones_initializer())
+  scales = getter(name + SCALE_SUFFIX, *args, **kwargs)
+  with _outside_control_flow(weights.graph):
+    float_weights = tf.to_float(weights)
+    dequantized = float_weights * scales
+  _QUANTIZED_PARTS.setdefault(dequantized.graph, {})[dequantized.name] = (
+      weights, scales, float_weights)
+  return dequantized
+
+
+@contextlib.contextmanager
+def _outside_control_flow(graph):
+  """Build ops outside of the while loop or cond being built, if any."""
+  # pylint: disable=protected-access
+  context = graph._get_control_flow_context()
+  graph._set_control_flow_context(None)
+  try:
+    yield
+  finally:
+    graph._set_control_flow_context(context)
+  # pylint: enable=protected-access
+
+
+def _quantized_parts(matrix):
+  """The int8 weights, scales and float weights of a dequantized matrix.
+
+  None if matrix isn't one.
+  """
+  if not isinstance(matrix, tf.Tensor):
+    return None
+  return _QUANTIZED_PARTS.get(matrix.graph, {}).get(matrix.name)
+
+
+def embedding_lookup(params, ids):
+  """tf.nn.embedding_lookup, scaling only the rows of ids if params is int8."""
+  parts = _quantized_parts(params)
+  if parts is None:
+    return tf.nn.embedding_lookup(params, ids)
+  weights, scales, _ = parts
+  return tf.to_float(tf.gather(weights, ids)) * tf.gather(scales, ids)
+
+
+def tensordot(inputs, matrix):
+  """inputs times matrix on the last axis of inputs.
+
+  For an int8 matrix, inputs are multiplied by its float weights, converted
+  once per session run, and the per column scales applied to the product.
+  """
+  parts = _quantized_parts(matrix)
+  if parts is None:
+    return tf.tensordot(inputs, matrix, [[-1], [0]])
+  _, scales, float_weights = parts
+  return tf.tensordot(inputs, float_weights, [[-1], [0]]) * scales[0]
+
+
+def gather_columns(matrix, columns):
+  """tf.gather of columns, dequantizing only those if matrix is int8."""
+  parts = _quantized_parts(matrix)
+  if parts is None:
+    return tf.gather(matrix, columns, axis=1)
+  weights, scales, _ = parts
+  return (tf.to_float(tf.gather(weights, columns, axis=1)) *
+          tf.gather(scales, columns, axis=1))
@@ -20,6 +20,7 @@ from __future__ import division
 from __future__ import print_function
 
 import codecs
+import collections
 import os
 import tensorflow as tf
 import numpy
@@ -33,6 +34,13 @@ SOS = "<s>"
 EOS = "</s>"
 UNK_ID = 0
 
+# Target vocab ids ranked by training frequency, written to out_dir.
+VOCAB_ORDER_FILE = "tgt_vocab_order.txt"
+# Source word to target word lexicon of the inference shortlist, in out_dir.
+SHORTLIST_LEXICON_FILE = "shortlist_lexicon.txt"
+# Candidates kept per source word in the shortlist lexicon file.
+MAX_LEXICON_CANDIDATES = 100
+
 
 def load_vocab(vocab_file):
   vocab = []
@@ -82,17 +90,131 @@ def check_vocab(vocab_file, out_dir,v_size, check_special_token=True, sos=None,
   return vocab_size, vocab_file
 
 
-def create_vocab_tables(src_vocab_file, tgt_vocab_file, share_vocab):
-  """Creates vocab tables for src_vocab_file and tgt_vocab_file."""
-  src_vocab_table = lookup_ops.index_table_from_file(
-      src_vocab_file, default_value=UNK_ID)
+def create_vocab_order(tgt_file, tgt_vocab_file, out_file):
+  """Rank target vocab ids by their count in tgt_file, most frequent first."""
+  vocab, vocab_size = load_vocab(tgt_vocab_file)
+  word_ids = dict((word, i) for i, word in enumerate(vocab))
+  counts = [0] * vocab_size
+  with codecs.getreader("utf-8")(tf.gfile.GFile(tgt_file, "rb")) as f:
+    for line in f:
+      for word in line.split():
+        if word in word_ids:
+          counts[word_ids[word]] += 1
+  order = sorted(range(vocab_size), key=lambda i: (-counts[i], i))
+  with codecs.getwriter("utf-8")(tf.gfile.GFile(out_file, "wb")) as f:
+    for word_id in order:
+      f.write("%d\n" % word_id)
+  return order
+
+
+def load_vocab_order(order_file):
+  """Load the target vocab ids written by create_vocab_order."""
+  with codecs.getreader("utf-8")(tf.gfile.GFile(order_file, "rb")) as f:
+    return [int(line) for line in f]
+
+
+def create_shortlist_lexicon(src_file, tgt_file, out_file):
+  """Mine source word to target word candidates from training pairs.
+
+  Each line of out_file is a source word, a tab, then up to
+  MAX_LEXICON_CANDIDATES target words ranked by the Dice coefficient of
+  their pair counts, which favours words specific to the source word over
+  words that are frequent everywhere.
+  """
+  src_counts = collections.Counter()
+  tgt_counts = collections.Counter()
+  pair_counts = collections.defaultdict(collections.Counter)
+  with codecs.getreader("utf-8")(tf.gfile.GFile(src_file, "rb")) as src_f:
+    with codecs.getreader("utf-8")(tf.gfile.GFile(tgt_file, "rb")) as tgt_f:
+      for src_line, tgt_line in zip(src_f, tgt_f):
+        src_words = set(src_line.split())
+        tgt_words = set(tgt_line.split())
+        src_counts.update(src_words)
+        tgt_counts.update(tgt_words)
+        for src_word in src_words:
+          pair_counts[src_word].update(tgt_words)
+
+  with codecs.getwriter("utf-8")(tf.gfile.GFile(out_file, "wb")) as f:
+    for src_word in sorted(pair_counts):
+      dice = [(2.0 * count / (src_counts[src_word] + tgt_counts[tgt_word]),
+               tgt_word)
+              for tgt_word, count in pair_counts[src_word].items()]
+      dice.sort(key=lambda x: (-x[0], x[1]))
+      candidates = [tgt_word for _, tgt_word in dice[:MAX_LEXICON_CANDIDATES]]
+      f.write("%s\t%s\n" % (src_word, " ".join(candidates)))
+
+
+def load_shortlist_lexicon(lexicon_file, order_file, src_vocab_file,
+                           tgt_vocab_file, num_frequent, num_candidates,
+                           special_words):
+  """Load the inference shortlist as target ids.
+
+  Args:
+    lexicon_file: file written by create_shortlist_lexicon.
+    order_file: file written by create_vocab_order.
+    num_frequent: number of most frequent target words always shortlisted.
+    num_candidates: lexicon candidates kept per source word, not counting
+      the frequent words.
+    special_words: target words always shortlisted, e.g. sos and eos.
+
+  Returns:
+    frequent_ids: target ids that are always shortlisted.
+    lexicon: [src_vocab_size, num_candidates] nested list of candidate target
+      ids of every source id, padded with -1.
+  """
+  src_vocab, src_vocab_size = load_vocab(src_vocab_file)
+  tgt_vocab, _ = load_vocab(tgt_vocab_file)
+  src_ids = dict((word, i) for i, word in enumerate(src_vocab))
+  tgt_ids = dict((word, i) for i, word in enumerate(tgt_vocab))
+
+  frequent_ids = load_vocab_order(order_file)[:num_frequent]
+  for word in special_words:
+    if word in tgt_ids and tgt_ids[word] not in frequent_ids:
+      frequent_ids.append(tgt_ids[word])
+  frequent = set(frequent_ids)
+
+  lexicon = [[-1] * num_candidates for _ in range(src_vocab_size)]
+  with codecs.getreader("utf-8")(tf.gfile.GFile(lexicon_file, "rb")) as f:
+    for line in f:
+      src_word, _, candidates = line.rstrip("\n").partition("\t")
+      if src_word not in src_ids:
+        continue
+      candidate_ids = [tgt_ids[word] for word in candidates.split()
+                       if word in tgt_ids and tgt_ids[word] not in frequent]
+      candidate_ids = candidate_ids[:num_candidates]
+      lexicon[src_ids[src_word]][:len(candidate_ids)] = candidate_ids
+  return frequent_ids, lexicon
+
+
+def create_vocab_tables(src_vocab_file, tgt_vocab_file, share_vocab,
+                        embed=False):
+  """Creates vocab tables for src_vocab_file and tgt_vocab_file.
+
+  With embed, the words are graph constants rather than read from the files
+  when the tables are initialized.
+  """
+  def create_table(vocab_file):
+    if embed:
+      return lookup_ops.index_table_from_tensor(
+          tf.constant(load_vocab(vocab_file)[0]), default_value=UNK_ID)
+    return lookup_ops.index_table_from_file(vocab_file, default_value=UNK_ID)
+
+  src_vocab_table = create_table(src_vocab_file)
   if share_vocab:
     tgt_vocab_table = src_vocab_table
   else:
-    tgt_vocab_table = lookup_ops.index_table_from_file(
-        tgt_vocab_file, default_value=UNK_ID)
+    tgt_vocab_table = create_table(tgt_vocab_file)
   return src_vocab_table, tgt_vocab_table
 
+
+def create_reverse_vocab_table(tgt_vocab_file, embed=False):
+  """Creates the id to word table of tgt_vocab_file."""
+  if embed:
+    return lookup_ops.index_to_string_table_from_tensor(
+        tf.constant(load_vocab(tgt_vocab_file)[0]), default_value=UNK)
+  return lookup_ops.index_to_string_table_from_file(
+      tgt_vocab_file, default_value=UNK)
+
 from tqdm import tqdm
 def count_lines(fname):
     with open(fname) as f: